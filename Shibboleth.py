@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests
 import logging
 import abc
 import sys
-from dataclasses import dataclass
+import json
+import threading
+from dataclasses import dataclass, field
 import keyring
-from bs4 import BeautifulSoup
+from extract import find_attr, input_value
+from stats import phase
+from transport import TransportSession
 
 class Institution():
     """
@@ -22,20 +25,67 @@ class Institution():
 
 @dataclass
 class Shibboleth:
-    _username = None
-    _password = None
-    _SAMLResponse = None
-    _headers = {
-        #'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:96.0) Gecko/20100101 Firefox/96.0'
-        }
-    _post = {}
-    _user_idp = None
-    _institution = None
-    session = requests.Session()
+    """
+    Credentials and session of one login. Every instance has its own
+    session, headers and SAML state, so that several logins don't share
+    their cookies.
+    
+    """
+    _username: str = None
+    _password: str = field(default = None, repr = False)
+    _SAMLResponse: str = field(default = None, repr = False)
+    _headers: dict = field(default_factory = dict)
+    _post: dict = field(default_factory = dict)
+    _user_idp: str = None
+    _institution: dict = None
+    _sessionService = "opal-scraper-session"
+    session: TransportSession = field(default_factory = TransportSession, repr = False)
     
     def setUser(self, username: str):
         self._username = username
-        self._password = keyring.get_password("system", self._username)
+        try:
+            self._password = keyring.get_password("system", self._username)
+        except keyring.errors.KeyringError as e:
+            logging.warning("Password could not be read: %s" % str(e))
+        
+    def saveSession(self):
+        """
+        Stores the cookies of the authenticated session in the keyring, 
+        next to the password of the user.
+        
+        """
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 
+                    'path': c.path, 'expires': c.expires, 'secure': c.secure}
+                   for c in self.session.cookies]
+        try:
+            keyring.set_password(self._sessionService, self._username, json.dumps(cookies))
+        except keyring.errors.KeyringError as e:
+            logging.warning("Session could not be stored: %s" % str(e))
+    
+    def loadSession(self) -> bool:
+        """
+        Restores the cookies stored by saveSession. Returns False if there
+        is no stored session.
+        
+        """
+        try:
+            stored = keyring.get_password(self._sessionService, self._username)
+        except keyring.errors.KeyringError as e:
+            logging.warning("Session could not be restored: %s" % str(e))
+            return False
+        
+        if not stored:
+            return False
+        
+        for cookie in json.loads(stored):
+            self.session.cookies.set(**cookie)
+        self.session.cookies.clear_expired_cookies()
+        
+        return len(self.session.cookies) > 0
+    
+    def clearSession(self):
+        self.session.cookies.clear()
+        self._SAMLResponse = None
         
 
 
@@ -63,6 +113,14 @@ class ServiceProviderInterface(metaclass = abc.ABCMeta):
         
         return NotImplementedError
     
+    def probe(self) -> bool:
+        """
+        Checks with a single cheap request whether the current session is
+        still logged into the service provider.
+        
+        """
+        return False
+    
 class TUCServiceProvider(ServiceProviderInterface):
     """
     Implements logic for connecting to TUC.
@@ -81,6 +139,7 @@ class TUCServiceProvider(ServiceProviderInterface):
         self.shib._post["TUC"] = 'https://www.tu-chemnitz.de/Shibboleth.sso/SAML2/POST'
         self.shib._user_idp = 'https://wtc.tu-chemnitz.de/shibboleth'
 
+    @phase("connect")
     def connect(self) -> Shibboleth:
         
         logging.info("Logging into TU Chemnitz.")
@@ -95,21 +154,18 @@ class TUCServiceProvider(ServiceProviderInterface):
             'Select':''})
         
         # Circumvent JavaScript redirection
-        soup = BeautifulSoup(response.text, 'html.parser') 
-        target = soup.find('a', {'id':  'redirect'}).get('href')
+        target = find_attr(response.text, 'a', 'href', {'id':  'redirect'})
         response = self.shib.session.get(target)
                
         
-        soup = BeautifulSoup(response.text, 'html.parser') 
-        AuthState = soup.find('input', {'name':  'AuthState'}).get('value')
+        AuthState = input_value(response.text, 'AuthState')
         response = self.shib.session.post(response.url, data = {'username': self.shib._username,
                                                         'AuthState': AuthState})
         response = self.shib.session.post(self._krbUrl+AuthState, 
                                   data = {'password': self.shib._password})
         response = self.shib.session.post(response.url, params = {'yes':''})
 
-        soup = BeautifulSoup(response.text, 'html.parser') 
-        self.shib._SAMLResponse =  soup.find('input', {'name':  'SAMLResponse'}).get('value')
+        self.shib._SAMLResponse = input_value(response.text, 'SAMLResponse')
         response = self.shib.session.post(self.shib._post["TUC"], data = {'SAMLResponse': self.shib._SAMLResponse})
         
         return self.shib
@@ -123,6 +179,7 @@ class OPALServiceProvider(ServiceProviderInterface):
         self.shib = shib
         self.shib._post["OPAL"] = 'https://bildungsportal.sachsen.de/dfn/Shibboleth.sso/SAML2/POST'
     
+    @phase("connect")
     def connect(self) -> Shibboleth:
         
         logging.info("Logging into OPAL.")
@@ -132,13 +189,20 @@ class OPALServiceProvider(ServiceProviderInterface):
             sys.exit(1)
             
         response = self.shib.session.get(self.url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        target = soup.find('form', {'id':  'id10'}).get('action') # Find wayf target
+        target = find_attr(response.text, 'form', 'action', {'id':  'id10'}) # Find wayf target
         response = self.shib.session.post(self.url[0:-6]+target, data = {'wayfselection': self.shib._institution["wayf"], 
                                                     'shibLogin': ''})
         response = self.ShibAuthHandler(response)
         
         return self.shib
+    
+    def probe(self) -> bool:
+        """
+        The wayf form is only offered to users that are not logged in.
+        
+        """
+        response = self.shib.session.get(self.url)
+        return response.ok and find_attr(response.text, 'form', 'id', {'id':  'id10'}) is None
         
     def ShibAuthHandler(self, response = None):
         """
@@ -148,8 +212,7 @@ class OPALServiceProvider(ServiceProviderInterface):
         """
         if(self.shib._institution["acro"] == Institution.TUC["acro"]):
             response = self.shib.session.post(response.url, params = {'yes':''})
-            soup = BeautifulSoup(response.text, 'html.parser')
-            self.shib._SAMLResponse = soup.find('input', {'name':  'SAMLResponse'}).get('value')
+            self.shib._SAMLResponse = input_value(response.text, 'SAMLResponse')
             response = self.shib.session.post(self.shib._post["OPAL"], data = {'RelayState': self._RelayState, 
                                                                        'SAMLResponse': self.shib._SAMLResponse})    
             return response
@@ -163,6 +226,7 @@ class VCSServiceProvider(ServiceProviderInterface):
         self.shib = shib
         self.shib._post["VCS"] = 'https://videocampus.sachsen.de/saml/acs'
     
+    @phase("connect")
     def connect(self): 
         
         logging.info("Logging into Video Campus Sachsen.")
@@ -178,6 +242,15 @@ class VCSServiceProvider(ServiceProviderInterface):
         response = self.ShibAuthHandler(response)
         return self.shib
     
+    def probe(self) -> bool:
+        """
+        VCS redirects users that are already logged in away from the login
+        page, everyone else gets the login page itself.
+        
+        """
+        response = self.shib.session.get(self.url, allow_redirects = False)
+        return response.is_redirect and '/login' not in response.headers.get('Location', '')
+    
     def ShibAuthHandler(self, response = None):
         """
         Different institutions may have different authentification services that
@@ -186,12 +259,106 @@ class VCSServiceProvider(ServiceProviderInterface):
         """
         if(self.shib._institution["acro"] == Institution.TUC["acro"]):
             response = self.shib.session.post(response.url, params = {'yes':''})
-            soup = BeautifulSoup(response.text, 'html.parser')
-            self.shib._SAMLResponse = soup.find('input', {'name':  'SAMLResponse'}).get('value')
-            RelayState = soup.find('input', {'name':  'RelayState'}).get('value')
+            self.shib._SAMLResponse = input_value(response.text, 'SAMLResponse')
+            RelayState = input_value(response.text, 'RelayState')
             response = self.shib.session.post(self.shib._post["VCS"], data = {'SAMLResponse': self.shib._SAMLResponse,
                                                                               'RelayState': RelayState})   
 
            
             return response
-             
+
+
+class PooledSession(TransportSession):
+    """
+    Session of one worker of a SessionPool. It starts with the cookies of
+    the pool's login and shares its connection pools, rate limits and
+    bandwidth cap. A response that shows the login has expired makes the
+    pool log in again, after which the request is sent once more.
+    
+    """
+    
+    def __init__(self, pool):
+        super().__init__()
+        base = pool.shib.session
+        self.headers.update(base.headers)
+        self.hooks = {event: list(hooks) for event, hooks in base.hooks.items()}
+        self.adapters = base.adapters
+        if isinstance(base, TransportSession):
+            self.timeout, self.rate, self.bandwidth = base.timeout, base.rate, base.bandwidth
+            self._buckets, self._lock = base._buckets, base._lock
+        self.generation = None
+        self._pool = pool
+    
+    def renew(self):
+        """
+        Takes over the cookies of the pool's login if they changed since
+        the last request.
+        
+        """
+        if self.generation != self._pool.generation:
+            with self._pool.lock:
+                self.cookies.clear()
+                self.cookies.update(self._pool.shib.session.cookies)
+                self.generation = self._pool.generation
+    
+    def request(self, method, url, *args, **kwargs):
+        self.renew()
+        generation = self.generation
+        response = super().request(method, url, *args, **kwargs)
+        if self._pool.expired(response):
+            response.close()
+            self._pool.refresh(generation)
+            self.renew()
+            response = super().request(method, url, *args, **kwargs)
+        return response
+    
+
+class SessionPool:
+    """
+    Hands out an independent session to each worker thread, all derived
+    from a single login. Workers pass the pool wherever a Shibboleth is
+    expected, shib.session is then the session of the calling thread.
+    
+    When the login expires, the first worker to notice calls login to
+    renew it. Workers that notice meanwhile wait for it and take over the
+    new cookies instead of logging in as well. probe, if given, is asked
+    first whether the login really expired.
+    
+    """
+    
+    # The portals redirect here once the login has expired
+    _login_urls = ("/login", "/saml/", "/Shibboleth.sso/", "wtc.tu-chemnitz.de")
+    
+    def __init__(self, shib: Shibboleth, login, probe = None):
+        self.shib = shib
+        self.generation = 0
+        self.lock = threading.RLock()
+        self._login = login
+        self._probe = probe
+        self._local = threading.local()
+    
+    @property
+    def session(self) -> PooledSession:
+        if getattr(self._local, "session", None) is None:
+            self._local.session = PooledSession(self)
+        return self._local.session
+    
+    def expired(self, response) -> bool:
+        if response.status_code == 401:
+            return True
+        return bool(response.history) and any(url in response.url for url in self._login_urls)
+    
+    def refresh(self, generation = None):
+        """
+        Logs in again, unless the login was already renewed since
+        generation, the one the caller's session used.
+        
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if self._probe is not None and self._probe(self.shib):
+                return
+            logging.info("Session has expired, logging in again.")
+            self.shib = self._login()
+            self.generation += 1
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import shutil
+import time
+from http.cookies import SimpleCookie
+from scraper import (node_media, parse_course_nodes, parse_master, parse_segments, medium_metadata,
+                     normalize_url, Frontier, MAX_PER_HOST)
+from integrity import file_digest
+from stats import STATS, phase
+import transport
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+HLS_URL = "https://videocampus.sachsen.de/media/hlsMedium/key/{sharekey}/format/auto/ext/mp4/learning/0/path/"
+
+class Page:
+    """
+    Response of the async client, with the attributes node_media expects
+    from a requests.Response.
+
+    """
+
+    def __init__(self, url, status, text, headers):
+        self.url = url
+        self.status_code = status
+        self.text = text
+        self.headers = headers
+        self.ok = status < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise IOError("%d Error for url: %s" % (self.status_code, self.url))
+
+
+class AsyncClient:
+    """
+    aiohttp session that carries the cookies of an authenticated Shibboleth.
+    A semaphore bounds the requests in flight, the connector caps them per
+    host. Timeouts, retries with backoff, the per-host rate limit and the
+    bandwidth cap follow the transport settings of the synchronous session.
+
+    """
+
+    _retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, shib, workers = 1, max_per_host = MAX_PER_HOST, timeout = transport.TIMEOUT,
+                 retries = transport.RETRIES, backoff = transport.BACKOFF, rate = transport.RATE,
+                 bandwidth = None):
+        if aiohttp is None:
+            raise ImportError("The async engine needs aiohttp, install it with pip install aiohttp")
+
+        jar = aiohttp.CookieJar()
+        for cookie in shib.session.cookies:
+            morsel = SimpleCookie()
+            morsel[cookie.name] = cookie.value
+            morsel[cookie.name]['domain'] = cookie.domain
+            morsel[cookie.name]['path'] = cookie.path
+            jar.update_cookies(morsel, URL("https://" + cookie.domain.lstrip(".")))
+
+        if not isinstance(timeout, (list, tuple)):
+            timeout = (timeout, timeout)
+
+        self._session = aiohttp.ClientSession(
+            cookie_jar = jar,
+            headers = dict(shib._headers),
+            timeout = aiohttp.ClientTimeout(sock_connect = timeout[0], sock_read = timeout[1]),
+            connector = aiohttp.TCPConnector(limit = max(workers, 1), limit_per_host = max_per_host))
+        self._slots = asyncio.Semaphore(max(workers, 1))
+        self._retries = retries
+        self._backoff = backoff
+        self._rate = rate
+        self._buckets = dict()
+        self._bandwidth = transport.TokenBucket(bandwidth) if bandwidth else None
+
+    async def close(self):
+        await self._session.close()
+
+    async def _throttle(self, url):
+        if not self._rate:
+            return
+        host = URL(url).host
+        if host not in self._buckets:
+            self._buckets[host] = transport.TokenBucket(self._rate)
+        wait = self._buckets[host].reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._buckets[host].reserve()
+
+    async def _consume(self, amount):
+        if self._bandwidth is None:
+            return
+        wait = self._bandwidth.reserve(amount)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._bandwidth.reserve(amount)
+
+    async def _request(self, url, headers, handle):
+        """
+        Sends a GET request and passes the response to the coroutine handle.
+        Connection errors, timeouts, 429 and 5xx are retried with
+        exponential backoff and jitter. headers may be a function, which is
+        called again for every attempt.
+
+        """
+        for attempt in range(self._retries + 1):
+            async with self._slots:
+                await self._throttle(url)
+                start = time.perf_counter()
+                try:
+                    sent = headers() if callable(headers) else headers
+                    async with self._session.get(url, headers = sent) as response:
+                        if response.status not in self._retry_status or attempt == self._retries:
+                            result, size = await handle(response)
+                            if STATS.enabled:
+                                STATS.add("GET", url, response.status, time.perf_counter() - start, size, attempt)
+                            return result
+                        retry_after = response.headers.get('Retry-After', '')
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self._retries:
+                        raise
+                    retry_after = ''
+
+            wait = self._backoff * 2 ** attempt + random.uniform(0, self._backoff)
+            if retry_after.isdigit():
+                wait = max(wait, int(retry_after))
+            logging.debug("Retry %s in %.1f s" % (url, wait))
+            await asyncio.sleep(wait)
+
+    async def get(self, url, headers = None):
+        async def handle(response):
+            text = await response.text()
+            return Page(str(response.url), response.status, text, response.headers), len(text)
+        return await self._request(url, headers, handle)
+
+    async def download(self, url, path, resume = False):
+        """
+        Downloads url to path and returns the size and the SHA-256 digest of
+        the file, like scraper.download_file. With resume, an existing
+        partial file is continued with a HTTP Range request. The range is
+        taken from the file again for every attempt, so a response that
+        broke off is continued where it ended instead of being appended
+        twice.
+
+        """
+
+        def headers():
+            if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+                return {'Range': "bytes=%d-" % os.path.getsize(path)}
+            return {}
+
+        async def handle(response):
+            ranged = 'Range' in response.request_info.headers
+            if ranged and response.status == 416:
+                return (os.path.getsize(path), file_digest(path).hexdigest()), 0
+            if response.status >= 400:
+                raise IOError("%d Error for url: %s" % (response.status, url))
+            if ranged and response.status == 206:
+                mode, digest = 'ab', file_digest(path)
+            else:
+                mode, digest = 'wb', hashlib.sha256()
+            size = 0
+            with open(path, mode) as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    await self._consume(len(chunk))
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            expected = response.headers.get('Content-Length')
+            if expected is not None and 'Content-Encoding' not in response.headers and size != int(expected):
+                raise IOError("Got %d of %s bytes for url: %s" % (size, expected, url))
+            return (os.path.getsize(path), digest.hexdigest()), size
+
+        return await self._request(url, headers, handle)
+
+
+@phase("get_course_nodes")
+async def get_course_nodes(client, url):
+    response = await client.get(url)
+    return parse_course_nodes(response.text)
+
+@phase("get_media")
+async def get_node_media(client, node, src, fingerprints = None, frontier = None, pending = None):
+    """
+    Drives node_media with the async client, like scraper.get_node_media.
+    All node crawls run at once, so a page the frontier doesn't know yet
+    may already be in flight for another node. pending maps the normalized
+    URLs of such requests to their task, which is then awaited instead of
+    requesting the page again.
+
+    """
+
+    async def fetch(url, headers):
+        if headers or pending is None:
+            return await client.get(url, headers)
+        key = normalize_url(url)
+        if key not in pending:
+            pending[key] = asyncio.ensure_future(client.get(url))
+            pending[key].add_done_callback(lambda task: pending.pop(key, None))
+        return await asyncio.shield(pending[key])
+
+    fingerprint = fingerprints.get(node[0]) if fingerprints is not None else None
+    steps = node_media(node, src, fingerprint, frontier)
+    response, error = None, None
+
+    while True:
+        try:
+            request = steps.throw(error) if error else steps.send(response)
+        except StopIteration as stop:
+            media, fingerprint = stop.value
+            break
+        try:
+            response, error = await fetch(*request), None
+        except Exception as e:
+            response, error = None, e
+
+    if fingerprints is not None:
+        if fingerprint is None:
+            fingerprints.pop(node[0], None)
+        else:
+            fingerprints[node[0]] = fingerprint
+
+    return media
+
+async def fetch_file(client, name, url, path, manifest = None):
+    file_path = path + "/" + name
+    if manifest is None:
+        await client.download(url, file_path)
+    elif not manifest.complete(name, file_path):
+        manifest.add(name, *await client.download(url, file_path, resume = True))
+    return file_path
+
+@phase("get_m3u8")
+async def get_m3u8(client, key, sharekey, path, manifest = None, quality = None):
+    logging.info("%s: Download m3u8 for %s" % (key, sharekey))
+    url = HLS_URL.format(sharekey=sharekey)
+    m3u8_path = await fetch_file(client, sharekey + ".m3u8", url + "m3u8", path, manifest)
+
+    with open(m3u8_path) as file:
+        variant = parse_master(file.read(), quality)
+
+    await fetch_file(client, sharekey + "_mp4.m3u8", url + variant, path, manifest)
+
+@phase("get_ts")
+async def get_ts(client, key, sharekey, path, manifest = None):
+    """
+    Downloads all segments of a medium concurrently, bounded by the client.
+    The first failed segment cancels the others.
+
+    """
+    url = HLS_URL.format(sharekey=sharekey)
+
+    with open(path + "/" + sharekey + "_mp4.m3u8") as file:
+        ts_keys = parse_segments(file.read())
+
+    logging.info("%s: Write files.txt for %s" % (key, sharekey))
+    with open(path + "/files.txt", "w") as text_file:
+        for ts in ts_keys:
+            print(f"file '{ts}' ", file=text_file)
+
+    async def fetch(tkey):
+        if manifest is not None and manifest.complete(tkey, path + "/" + tkey):
+            return
+        logging.info("%s: Download %s" % (key, tkey))
+        await fetch_file(client, tkey, url + tkey, path, manifest)
+
+    tasks = [asyncio.ensure_future(fetch(tkey)) for tkey in ts_keys]
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        raise
+
+
+def update(shib, store, incremental = False, **options):
+    """
+    Crawls all repositories and course nodes under one event loop and adds
+    the media found to the store, like scraper.opal_scraper. Course nodes
+    listed by several repositories are crawled once.
+
+    """
+    content = store.content()
+    fingerprints = store.get("fingerprints", {}) if incremental else None
+    frontier = Frontier()
+    crawls = dict()
+    pending = dict()
+
+    async def crawl():
+        client = AsyncClient(shib, **options)
+        try:
+            def crawl_node(node, target):
+                url = normalize_url(node[0])
+                if url not in crawls:
+                    crawls[url] = asyncio.ensure_future(get_node_media(client, node, target, fingerprints, frontier, pending))
+                return crawls[url]
+
+            async def crawl_repository(key):
+                logging.info("Checking for content for " + key)
+                nodes = await get_course_nodes(client, content[key].get("target"))
+                found = await asyncio.gather(*[crawl_node(node, content[key].get("target")) for node in nodes])
+                return nodes, [medium for media in found for medium in media]
+
+            return dict(zip(content, await asyncio.gather(*[crawl_repository(key) for key in content])))
+        finally:
+            await client.close()
+
+    results = asyncio.run(crawl())
+
+    for key, (nodes, found) in results.items():
+        added = store.add_media(key, found)
+        logging.info("%s: Found %d new media" % (key, len(added)))
+
+    if incremental:
+        visited = {node[0] for nodes, found in results.values() for node in nodes}
+        store.set("fingerprints", {url: fingerprints[url] for url in fingerprints if url in visited})
+
+    return 0
+
+def download(shib, store, jobs, resume = False, qualities = None, budget = None, **options):
+    """
+    Downloads the media of jobs, a list of (key, medium) in the order of
+    the scheduler, under one event loop. Up to workers media are in
+    progress at once, their segment requests share the bounds of the
+    client. qualities maps labels to the quality of their variants. Once
+    the temp space exceeds the budget, no further media are started.
+    Returns 1 if a download failed.
+
+    """
+    failed = list()
+
+    async def download_medium(client, media_slots, key, medium):
+        sharekey = medium.get("sharekey")
+        path = "./{key}/tmp_{sharekey}".format(key=key, sharekey=sharekey)
+        quality = (qualities or {}).get(key)
+
+        async with media_slots:
+            if budget is not None and not budget.admit():
+                logging.warning("%s: Skipped %s, run --convert to free temp space" % (key, sharekey))
+                return
+            if not (resume and os.path.isdir(path)):
+                os.makedirs(path, exist_ok = True)
+            manifest = store.manifest(key, sharekey, path)
+
+            try:
+                await get_m3u8(client, key, sharekey, path, manifest, quality)
+                await get_ts(client, key, sharekey, path, manifest)
+                metadata = medium_metadata(path, sharekey, manifest)
+            except Exception as e:
+                logging.error("%s: Download of %s failed: %s" % (key, sharekey, str(e)))
+                if not resume:
+                    shutil.rmtree(path, ignore_errors = True)
+                failed.append((key, sharekey))
+                return
+
+            if quality:
+                metadata["quality"] = quality
+            store.update_medium(key, sharekey, downloaded = True, **metadata)
+
+    async def run():
+        client = AsyncClient(shib, **options)
+        media_slots = asyncio.Semaphore(max(options.get("workers", 1), 1))
+        try:
+            await asyncio.gather(*[download_medium(client, media_slots, key, medium)
+                                   for key, medium in jobs])
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+    return 0 if not failed else 1
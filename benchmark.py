@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of --update and --download. A local HTTP server stands in
+for TU Chemnitz, OPAL and Video Campus Sachsen, and all requests of the
+session are redirected to it, or a capture of a real run is replayed.
+The startup of a command that doesn't talk to the portals is measured as
+well. Type ./benchmark.py -h for the options.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from capture import ReplayAdapter
+from Shibboleth import Shibboleth, SessionPool, TUCServiceProvider, OPALServiceProvider, VCSServiceProvider
+from scraper import opal_scraper, get_m3u8, get_ts
+from store import JSONStore
+
+# Everything the login chain looks for, served for every login step
+LOGIN_PAGE = """<html><body>
+<a id="redirect" href="https://wtc.tu-chemnitz.de/krb/redirect">redirect</a>
+<form id="id10" action="/opal/wayf"></form>
+<input type="hidden" name="AuthState" value="state"/>
+<input type="hidden" name="SAMLResponse" value="response"/>
+<input type="hidden" name="RelayState" value="relay"/>
+</body></html>"""
+
+# Prefix of the requests of the download phase
+HLS_PREFIX = "https://videocampus.sachsen.de/media/hlsMedium/"
+
+# Modules that commands which don't talk to the portals must not import
+HEAVY = ("requests", "bs4", "lxml", "keyring", "aiohttp", "asyncio")
+
+class Portal:
+    """
+    Synthetic OPAL repositories with course nodes and VCS media. Even course
+    nodes embed their medium through an iframe, odd ones link to VCS.
+
+    """
+
+    def __init__(self, repositories, nodes, segments, segment_size):
+        self.repositories = repositories
+        self.nodes = nodes
+        self.segments = segments
+        self.segment = os.urandom(segment_size)
+
+    def target(self, repository):
+        return "https://bildungsportal.sachsen.de/opal/auth/RepositoryEntry/%d" % repository
+
+    def page(self, host, path):
+        match = re.fullmatch(r"/opal/auth/RepositoryEntry/(\d+)", path)
+        if host == "bildungsportal.sachsen.de" and match:
+            repository = int(match.group(1))
+            nodes = ",".join('{"href":"%s/CourseNode/%d","title":"Node %d"}' % (self.target(repository), node, node)
+                             for node in range(self.nodes))
+            return "<script>var nodes = [%s];</script>" % nodes
+
+        match = re.fullmatch(r"/opal/auth/RepositoryEntry/(\d+)/CourseNode/(\d+)", path)
+        if host == "bildungsportal.sachsen.de" and match:
+            repository, node = match.groups()
+            if int(node) % 2 == 0:
+                return '<iframe src="/opal/iframe/%s/%s"></iframe>' % (repository, node)
+            return '<a href="https://videocampus.sachsen.de/m/R%sN%s">Video</a>' % (repository, node)
+
+        match = re.fullmatch(r"/opal/iframe/(\d+)/(\d+)", path)
+        if host == "bildungsportal.sachsen.de" and match:
+            return '<iframe src="https://videocampus.sachsen.de/media/embed?key=R%sN%s"></iframe>' % match.groups()
+
+        match = re.fullmatch(r"/(?:m/|media/embed\?key=)(\w+)", path)
+        if host == "videocampus.sachsen.de" and match:
+            return ('<input type="hidden" name="sharekey" value="%s"/>'
+                    '<video data-piwik-title="Lecture %s"></video>' % (match.group(1), match.group(1)))
+
+        match = re.fullmatch(r"/media/hlsMedium/key/\w+/format/auto/ext/mp4/learning/0/path/(.+)", path)
+        if host == "videocampus.sachsen.de" and match:
+            name = match.group(1)
+            if name == "m3u8":
+                return "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000000,RESOLUTION=1280x720\nindex.m3u8\n"
+            if name == "index.m3u8":
+                lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:10"]
+                for segment in range(self.segments):
+                    lines += ["#EXTINF:10.0,", "seg%d.ts" % segment]
+                return "\n".join(lines + ["#EXT-X-ENDLIST", ""])
+            if re.fullmatch(r"seg\d+\.ts", name):
+                return self.segment
+
+        return LOGIN_PAGE
+
+
+def serve(portal, latency, bandwidth):
+    """
+    Starts the stand-in server in a background thread. Every response is
+    delayed by latency seconds and sent at bandwidth bytes per second,
+    unless bandwidth is 0.
+
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if length:
+                self.rfile.read(length)
+
+            host, _, path = self.path.lstrip("/").partition("/")
+            body = portal.page(host, "/" + path)
+            if isinstance(body, str):
+                body = body.encode()
+
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            chunk = 65536
+            for offset in range(0, len(body), chunk):
+                self.wfile.write(body[offset:offset + chunk])
+                if bandwidth:
+                    time.sleep(min(chunk, len(body) - offset) / bandwidth)
+
+        do_GET = respond
+        do_POST = respond
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+class LocalAdapter(HTTPAdapter):
+    """
+    Sends every request to the stand-in server, with the original host as
+    the first path component. Requests and responses keep their original
+    URL, so cookies and relative URLs work as with the real portals.
+
+    """
+
+    def __init__(self, address, **kwargs):
+        self._address = address
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = request.url
+        parts = urlsplit(url)
+        request.url = "http://%s:%d/%s%s" % (self._address + (parts.netloc, parts.path))
+        if parts.query:
+            request.url += "?" + parts.query
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            request.url = url
+        response.url = url
+        return response
+
+
+class Meter:
+    """
+    Counts requests and received bytes of a session by phase.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = list()
+        self.requests = 0
+        self.bytes = 0
+
+    def hook(self, response, *args, **kwargs):
+        with self._lock:
+            self.requests += 1
+            self.bytes += int(response.headers.get('Content-Length', 0))
+
+    def measure(self, name, function, *args, **kwargs):
+        requests, received = self.requests, self.bytes
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        wall = time.perf_counter() - start
+        requests, received = self.requests - requests, self.bytes - received
+        self.phases.append({"phase": name, "wall": wall, "requests": requests,
+                            "requests/s": requests / wall, "bytes": received,
+                            "MB/s": received / wall / 1e6})
+
+
+def run(args):
+    if args.replay:
+        server = None
+        adapter = ReplayAdapter(args.replay, args.replay_speed)
+        targets = adapter.meta.get("repositories", {})
+    else:
+        portal = Portal(args.repositories, args.nodes, args.segments, args.segment_size)
+        server = serve(portal, args.latency, args.bandwidth * 1e6)
+        adapter = LocalAdapter(server.server_address, pool_connections = args.workers * 2,
+                               pool_maxsize = args.workers * 2)
+        targets = {"R%d" % repository: portal.target(repository) for repository in range(args.repositories)}
+
+    shib = Shibboleth()
+    shib.session.mount("https://", adapter)
+    shib.session.mount("http://", adapter)
+    meter = Meter()
+    shib.session.hooks['response'].append(meter.hook)
+
+    def login():
+        shib._username, shib._password = "user", "password"
+        TUCServiceProvider(shib).connect()
+        OPALServiceProvider(shib).connect()
+        VCSServiceProvider(shib).connect()
+        return shib
+
+    pool = SessionPool(shib, login)
+
+    def download():
+        contents = store.content()
+        for key in contents:
+            for medium in contents[key]["media"]:
+                path = "./%s/tmp_%s" % (key, medium["sharekey"])
+                os.makedirs(path)
+                try:
+                    get_m3u8(key, medium["sharekey"], path, pool)
+                    get_ts(key, medium["sharekey"], path, pool, workers = args.workers)
+                except Exception as e:
+                    # Captures may end before all media were downloaded
+                    if not args.replay:
+                        raise
+                    logging.warning("%s: %s is not in the capture: %s" % (key, medium["sharekey"], str(e)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            store = JSONStore()
+            for key, target in targets.items():
+                store.add_repository(key, target)
+
+            meter.measure("login", login)
+            if not args.replay or any(adapter.captured(target) for target in targets.values()):
+                meter.measure("update", opal_scraper, pool, store, workers = args.workers)
+            if not args.replay or adapter.captured(HLS_PREFIX):
+                meter.measure("download", download)
+        finally:
+            os.chdir(cwd)
+            if server is not None:
+                server.shutdown()
+
+    return meter.phases
+
+def startup(runs):
+    """
+    Measures the best wall time of --add in a fresh interpreter over runs
+    runs. Returns it as a phase, together with the heavy modules --add
+    imported.
+
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opal-scraper.py")
+    walls = list()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for run in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, "-vvvv", "--add", "R%d" % run,
+                            "https://bildungsportal.sachsen.de/opal/auth/RepositoryEntry/%d" % run],
+                           cwd = directory, check = True)
+            walls.append(time.perf_counter() - start)
+
+        result = subprocess.run([sys.executable, "-X", "importtime", script, "-vvvv", "--delete", "R0"],
+                                cwd = directory, check = True, capture_output = True, text = True)
+
+    imported = {line.rpartition("|")[2].strip().split(".")[0] for line in result.stderr.splitlines()
+                if line.startswith("import time:")}
+    phase = {"phase": "startup", "wall": min(walls), "requests": 0, "requests/s": 0.0,
+             "bytes": 0, "MB/s": 0.0}
+    return phase, sorted(imported & set(HEAVY))
+
+def compare(phases, baseline, tolerance):
+    """
+    Returns the phases whose wall time exceeds the baseline by more than
+    the tolerated fraction.
+
+    """
+    wall = {phase["phase"]: phase["wall"] for phase in baseline}
+    return [phase["phase"] for phase in phases
+            if phase["phase"] in wall and phase["wall"] > wall[phase["phase"]] * (1 + tolerance)]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Benchmark --update and --download against a local stand-in server.")
+    parser.add_argument("--repositories", help="number of repositories", type=int, default=3)
+    parser.add_argument("--nodes", help="course nodes per repository", type=int, default=10)
+    parser.add_argument("--segments", help="segments per medium", type=int, default=20)
+    parser.add_argument("--segment-size", help="bytes per segment", type=int, default=262144)
+    parser.add_argument("--latency", help="latency per request in seconds", type=float, default=0.02)
+    parser.add_argument("--bandwidth", help="bandwidth per response in MB/s, 0 is unlimited",
+                        type=float, default=0)
+    parser.add_argument("--workers", help="number of concurrent requests", type=int, default=4)
+    parser.add_argument("--json", help="write the results to FILE", type=str, metavar=('FILE'))
+    parser.add_argument("--baseline", help="fail if a phase is slower than in FILE",
+                        type=str, metavar=('FILE'))
+    parser.add_argument("--tolerance", help="tolerated slowdown against the baseline",
+                        type=float, default=0.2)
+    parser.add_argument("--replay", help="replay the capture FILE of a real run instead of the "
+                        "stand-in server", type=str, metavar=('FILE'))
+    parser.add_argument("--replay-speed", help="speedup of the replay, 0 doesn't wait at all",
+                        type=float, default=1.0)
+    parser.add_argument("--startup-runs", help="runs of --add to measure the startup",
+                        type=int, default=5)
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+
+    phase, heavy = startup(args.startup_runs)
+    phases = [phase] + run(args)
+
+    print("%-10s %10s %10s %12s %10s" % ("phase", "wall [s]", "requests", "requests/s", "MB/s"))
+    for phase in phases:
+        print("%-10s %10.3f %10d %12.1f %10.2f" % (phase["phase"], phase["wall"], phase["requests"],
+                                                   phase["requests/s"], phase["MB/s"]))
+
+    if args.json:
+        with open(args.json, "w") as write_file:
+            json.dump({"parameters": vars(args), "phases": phases}, write_file, indent = 2)
+
+    if heavy:
+        print("--add imported " + ", ".join(heavy))
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as read_file:
+            regressions = compare(phases, json.load(read_file)["phases"], args.tolerance)
+        if regressions:
+            print("Regression in " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zipfile
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Form fields, query parameters and hidden inputs that carry credentials or
+# SAML state, and headers that carry cookies
+SECRETS = ("username", "password", "SAMLResponse", "SAMLRequest", "RelayState", "AuthState")
+SECRET_HEADERS = ("Cookie", "Set-Cookie", "Authorization", "Proxy-Authorization")
+REDACTED = "REDACTED"
+# Only bodies of these content types are redacted, media are left alone
+TEXT_TYPES = ("text", "html", "xml", "json", "javascript")
+
+_inputs = re.compile(rb'<input\b[^>]*>', re.I)
+_input_name = re.compile(rb'name\s*=\s*["\']?([^"\'\s>]+)', re.I)
+_input_value = re.compile(rb'(value\s*=\s*)(["\'])(.*?)\2', re.I | re.S)
+
+def redact_url(url, words = ()):
+    """
+    Returns url with the values of secret query parameters replaced.
+
+    """
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    query = [(key, REDACTED if key in SECRETS or value in words else value)
+             for key, value in parse_qsl(parts.query, keep_blank_values = True)]
+    return urlunsplit(parts._replace(query = urlencode(query)))
+
+def digest(word, salt):
+    """
+    Returns the salted SHA-256 of word, which meta.json keeps instead of the
+    redacted words themselves.
+
+    """
+    return hashlib.sha256((salt + word).encode()).hexdigest()
+
+def redact_body(body, words = ()):
+    """
+    Returns body, bytes, with the values of secret hidden inputs and all
+    occurrences of words, e.g. the username, replaced.
+
+    """
+    def redact_input(match):
+        tag = match.group(0)
+        name = _input_name.search(tag)
+        if name and name.group(1).decode(errors = "replace") in SECRETS:
+            tag = _input_value.sub(lambda value: value.group(1) + value.group(2) + REDACTED.encode()
+                                   + value.group(2), tag)
+        return tag
+
+    body = _inputs.sub(redact_input, body)
+    for word in words:
+        if word:
+            body = body.replace(word.encode(), REDACTED.encode())
+    return body
+
+def redact_headers(headers, words = ()):
+    redacted = dict()
+    for key, value in headers.items():
+        if key.title() in SECRET_HEADERS:
+            value = REDACTED
+        elif key.lower() == "location":
+            value = redact_url(value, words)
+        redacted[key] = value
+    return redacted
+
+def redact_form(body, words = ()):
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode(errors = "replace")
+    return urlencode([(key, REDACTED if key in SECRETS or value in words else value)
+                      for key, value in parse_qsl(body, keep_blank_values = True)])
+
+
+class Archive:
+    """
+    Capture of the HTTP exchanges of a run. The archive is a zip file with
+    trace.jsonl, one exchange per line in the order the responses arrived,
+    and the response bodies under bodies/, named by their SHA-256 so that
+    equal bodies are stored once. meta.json holds the repositories of the
+    store, so that a benchmark can replay the trace, and the salted digests
+    of the redacted words, so that a replay can redact URLs the same way.
+
+    """
+
+    def __init__(self, fn, words = (), meta = None):
+        self.fn = fn
+        self.words = tuple(word for word in words if word)
+        self.exchanges = list()
+        self._zip = zipfile.ZipFile(fn, "w", zipfile.ZIP_DEFLATED)
+        self._bodies = set()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        salt = os.urandom(16).hex()
+        words = {"salt": salt, "sha256": [digest(word, salt) for word in self.words]}
+        self._zip.writestr("meta.json", json.dumps(dict(meta or {}, words = words, version = 1), indent = 2))
+
+    def add(self, request, response = None, body = None, started = 0.0, elapsed = 0.0, seconds = 0.0,
+            error = None):
+        exchange = {"start": round(started - self._start, 6), "method": request.method,
+                    "url": redact_url(request.url, self.words),
+                    "request": {"headers": redact_headers(request.headers, self.words),
+                                "body": redact_form(request.body, self.words)},
+                    "elapsed": round(elapsed, 6), "seconds": round(seconds, 6)}
+        if error is not None:
+            exchange["error"] = error
+        else:
+            body = body or b""
+            if any(kind in response.headers.get("Content-Type", "text/html") for kind in TEXT_TYPES):
+                body = redact_body(body, self.words)
+            headers = redact_headers(response.headers, self.words)
+            # The body is stored decoded
+            headers.pop("Content-Encoding", None)
+            headers["Content-Length"] = str(len(body))
+            exchange.update(status = response.status_code, reason = response.reason, headers = headers,
+                            body = hashlib.sha256(body).hexdigest())
+
+        with self._lock:
+            if error is None and exchange["body"] not in self._bodies:
+                self._bodies.add(exchange["body"])
+                self._zip.writestr("bodies/" + exchange["body"], body)
+            self.exchanges.append(exchange)
+
+    def close(self):
+        with self._lock:
+            if self._zip is None:
+                return
+            self._zip.writestr("trace.jsonl", "".join(json.dumps(exchange) + "\n"
+                                                      for exchange in self.exchanges))
+            self._zip.close()
+            self._zip = None
+        logging.info("Captured %d requests to %s" % (len(self.exchanges), self.fn))
+
+
+class CaptureAdapter(BaseAdapter):
+    """
+    Passes requests on to adapter and adds every exchange to the archive.
+    The body is read right away, so that the time until it arrived
+    completely is part of the capture.
+
+    """
+
+    def __init__(self, adapter, archive):
+        super().__init__()
+        self._adapter = adapter
+        self._archive = archive
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self._adapter.send(request, **kwargs)
+            elapsed = time.perf_counter() - started
+            body = response.content
+        except requests.RequestException as e:
+            self._archive.add(request, started = started, seconds = time.perf_counter() - started,
+                              error = "%s: %s" % (type(e).__name__, str(e)))
+            raise
+        self._archive.add(request, response, body, started, elapsed, time.perf_counter() - started)
+        return response
+
+    def close(self):
+        self._adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Serves the responses of an archive instead of sending requests. They
+    are looked up by method and URL, redacted like the capture did. A
+    request sent more often than captured gets the last response again, an
+    unknown one a 404. Every response is delayed by the time the original
+    took, divided by speed, or not at all with speed 0.
+
+    """
+
+    def __init__(self, fn, speed = 1.0):
+        super().__init__()
+        self.speed = speed
+        self._zip = zipfile.ZipFile(fn)
+        self._lock = threading.Lock()
+        self._exchanges = collections.defaultdict(collections.deque)
+        self.meta = json.loads(self._zip.read("meta.json"))
+        words = self.meta.get("words", {})
+        self._salt = words.get("salt", "")
+        self._digests = set(words.get("sha256", ()))
+        for line in self._zip.read("trace.jsonl").decode().splitlines():
+            exchange = json.loads(line)
+            self._exchanges[(exchange["method"], exchange["url"])].append(exchange)
+
+    def captured(self, prefix):
+        """
+        Returns True if a request to a URL starting with prefix was
+        captured.
+
+        """
+        return any(url.startswith(prefix) for method, url in self._exchanges)
+
+    def _redact(self, url):
+        """
+        Returns url redacted like the capture did, with the query values
+        whose digest was kept as words.
+
+        """
+        words = [value for key, value in parse_qsl(urlsplit(url).query, keep_blank_values = True)
+                 if digest(value, self._salt) in self._digests]
+        return redact_url(url, words)
+
+    def _next(self, request):
+        url = self._redact(request.url)
+        with self._lock:
+            exchanges = self._exchanges.get((request.method, url))
+            if not exchanges:
+                return None, b""
+            exchange = exchanges.popleft() if len(exchanges) > 1 else exchanges[0]
+            body = self._zip.read("bodies/" + exchange["body"]) if "body" in exchange else b""
+        return exchange, body
+
+    def send(self, request, **kwargs):
+        exchange, body = self._next(request)
+        if exchange is None:
+            logging.warning("%s %s is not in the capture" % (request.method, request.url))
+            exchange = {"status": 404, "reason": "Not Found", "headers": {}, "seconds": 0}
+        if self.speed:
+            time.sleep(exchange["seconds"] / self.speed)
+        if "error" in exchange:
+            raise requests.ConnectionError(exchange["error"], request = request)
+
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.reason = exchange["reason"]
+        response.headers = CaseInsensitiveDict(exchange["headers"])
+        response._content = body
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        # Shared by all sessions, the trace closes the archive
+        pass
+
+
+class Trace:
+    """
+    Capture or replay of the current run. Sessions made after record or
+    replay was called are passed to install, which mounts the adapters.
+
+    """
+
+    def __init__(self):
+        self.mode = None
+        self.archive = None
+        self.replay_adapter = None
+
+    def record(self, fn, words = (), meta = None):
+        self.mode = "capture"
+        self.archive = Archive(fn, words, meta)
+
+    def replay(self, fn, speed = 1.0):
+        self.mode = "replay"
+        self.replay_adapter = ReplayAdapter(fn, speed)
+
+    def install(self, session):
+        if self.mode == "capture":
+            for prefix, adapter in list(session.adapters.items()):
+                session.adapters[prefix] = CaptureAdapter(adapter, self.archive)
+        elif self.mode == "replay":
+            for prefix in list(session.adapters):
+                session.adapters[prefix] = self.replay_adapter
+        return session
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+        if self.replay_adapter is not None:
+            self.replay_adapter._zip.close()
+
+
+TRACE = Trace()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+class SharekeyIndex:
+    """
+    Remembers which repository owns the single copy of a medium that is
+    linked from several repositories. The index is kept in the "sharekeys"
+    setting of the store, so that the owner stays the same across runs.
+    Owners whose repository was deleted, or no longer lists the medium,
+    are forgotten.
+
+    """
+
+    def __init__(self, store, contents):
+        self._store = store
+        self._lock = threading.Lock()
+        self.owners = {sharekey: label for sharekey, label in store.get("sharekeys", {}).items()
+                       if label in contents
+                       and any(medium.get("sharekey") == sharekey
+                               for medium in contents[label].get("media", []))}
+
+    def owner(self, label, sharekey):
+        """
+        Returns the repository that owns the medium, which is label if no
+        other repository claimed it before.
+
+        """
+        with self._lock:
+            return self.owners.setdefault(sharekey, label)
+
+    def forget(self, labels):
+        """
+        Forgets the media owned by labels, e.g. repositories that were
+        deleted, so that the remaining repositories can claim them.
+
+        """
+        with self._lock:
+            self.owners = {sharekey: label for sharekey, label in self.owners.items()
+                           if label not in labels}
+
+    def save(self):
+        with self._lock:
+            self._store.set("sharekeys", dict(self.owners))
+
+
+def link(source, target):
+    """
+    Links target to source, with a hardlink if possible and a relative
+    symlink otherwise, e.g. across file systems.
+
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(os.path.relpath(source, os.path.dirname(target)), target)
+
+def link_copies(store, output_path, sharekey = None):
+    """
+    Links the media that are a copy of a medium of another repository to
+    the file of their owner, once it exists. Copies of a repository that
+    is gone are marked as not downloaded, so that the next run fetches
+    them. With sharekey, only the copies of that medium are handled.
+    Returns the number of links made.
+
+    """
+    contents = store.content()
+    linked = 0
+
+    for label in contents:
+        for medium in contents[label].get("media", []):
+            owner = medium.get("copy_of")
+            if not owner or (sharekey is not None and medium.get("sharekey") != sharekey):
+                continue
+
+            if owner not in contents:
+                logging.info("%s: %s lost its owner %s" % (label, medium.get("sharekey"), owner))
+                store.update_medium(label, medium.get("sharekey"), downloaded = False, copy_of = None)
+                continue
+
+            audio = medium.get("quality") == "audio"
+            source = output_path(owner, medium.get("sharekey"), audio)
+            target = output_path(label, medium.get("sharekey"), audio)
+            if os.path.exists(source) and not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok = True)
+                link(source, target)
+                logging.info("%s: Linked %s to the copy of %s" % (label, medium.get("sharekey"), owner))
+                linked += 1
+
+    return linked
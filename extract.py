@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import html
+import importlib.util
+import re
+
+# BeautifulSoup and its parser are only imported once a page needs them
+PARSER = None
+
+_attributes = re.compile(r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+# Comments and the content of scripts and styles, which hold no tags
+_hidden = re.compile(r"<!--.*?-->|(<(script|style)(?=[\s/>])[^>]*>).*?</\2\s*>", re.IGNORECASE | re.DOTALL)
+_hidden_start = re.compile(r"<!--|<(?:script|style)(?=[\s/>])", re.IGNORECASE)
+
+def _opening(tag):
+    return r"<%s(?=[\s/>])" % re.escape(tag)
+
+def _markup(page):
+    """
+    Returns page without comments and without the content of scripts and
+    styles, and whether all of them were terminated.
+
+    """
+    if not _hidden_start.search(page):
+        return page, True
+    page = _hidden.sub(lambda hidden: hidden.group(1) + "</%s>" % hidden.group(2) if hidden.group(1) else "",
+                       page)
+    opened = len(_hidden_start.findall(page))
+    closed = len(re.findall(r"</(?:script|style)\s*>", page, re.IGNORECASE))
+    return page, opened == closed
+
+def _start_tags(page, tag):
+    """
+    Returns the attributes of all start tags of the given name and whether
+    the scan can be trusted, that is every start tag was terminated and
+    its attributes were read completely. This is a plain RegEx scan of the
+    page, so it doesn't know about comments or scripts, but it is a lot
+    faster than building a tree.
+
+    """
+    tags = list()
+    trusted = True
+    for match in re.finditer(_opening(tag) + r"([^>]*)>", page, re.IGNORECASE):
+        attrs = dict()
+        for name, double, single, bare in _attributes.findall(match.group(1)):
+            attrs.setdefault(name.lower(), html.unescape(double or single or bare))
+        # A quoted > or an unterminated tag leaves parts of the tag unread
+        rest = _attributes.sub("", match.group(1))
+        trusted = trusted and "<" not in match.group(1) and not rest.strip(" \t\r\n/")
+        tags.append(attrs)
+    opened = len(re.findall(_opening(tag), page, re.IGNORECASE))
+    return tags, trusted and len(tags) == opened
+
+def _matches(attrs, match):
+    return all(attrs.get(name) == val for name, val in match.items())
+
+def _soup(page, tag, match):
+    global PARSER
+    from bs4 import BeautifulSoup, SoupStrainer
+    if PARSER is None:
+        PARSER = 'lxml' if importlib.util.find_spec("lxml") else 'html.parser'
+    strainer = SoupStrainer(tag, attrs = match or {})
+    return BeautifulSoup(page, PARSER, parse_only = strainer)
+
+def find_all_attr(page, tag, attr, match = None, pattern = None):
+    """
+    Returns the value of attr for all tags whose attributes equal match and
+    whose attr matches the RegEx pattern. Tags in comments, scripts and
+    styles don't count. Only if the fast path can't read one of the tags,
+    e.g. because it or a comment isn't terminated, the page is parsed by
+    BeautifulSoup, restricted to the tag in question.
+
+    """
+    match = match or {}
+    if not re.search(_opening(tag), page, re.IGNORECASE):
+        return list()
+
+    markup, trusted = _markup(page)
+    tags, scanned = _start_tags(markup, tag)
+    if trusted and scanned:
+        return [attrs[attr] for attrs in tags
+                if attr in attrs and _matches(attrs, match)
+                and (pattern is None or pattern.search(attrs[attr]))]
+
+    return [element.get(attr) for element in _soup(page, tag, match).find_all(tag)
+            if element.get(attr) is not None
+            and (pattern is None or pattern.search(element.get(attr)))]
+
+def find_attr(page, tag, attr, match = None, pattern = None):
+    """
+    Returns the value of attr of the first matching tag or None.
+
+    """
+    values = find_all_attr(page, tag, attr, match, pattern)
+    return values[0] if values else None
+
+def input_value(page, name):
+    """
+    Returns the value of the input named name, e.g. hidden form fields.
+
+    """
+    return find_attr(page, 'input', 'value', {'name': name})
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import subprocess
+
+# Seconds an output may fall short of its playlist, at least 1 % of it
+TOLERANCE = 2.0
+
+def file_digest(path, digest = None):
+    """
+    Feeds the file at path into digest, a new SHA-256 by default, and
+    returns it.
+
+    """
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest
+
+def medium_checksum(digests):
+    """
+    Returns the checksum of a medium, the SHA-256 of the SHA-256 digests of
+    its segments in playlist order, or None if a digest is missing.
+
+    """
+    if not digests or None in digests:
+        return None
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+def check_segments(path, manifest, names):
+    """
+    Returns the segments of names in path that are missing or whose size
+    or digest differs from the manifest. Segments the manifest doesn't know
+    only have to exist.
+
+    """
+    broken = list()
+    for name in names:
+        file_path = os.path.join(path, name)
+        if not os.path.exists(file_path):
+            broken.append(name)
+        elif name in manifest.files and os.path.getsize(file_path) != manifest.files[name]:
+            broken.append(name)
+        elif manifest.digests.get(name) and file_digest(file_path).hexdigest() != manifest.digests[name]:
+            broken.append(name)
+    return broken
+
+def probe_duration(path):
+    """
+    Returns the duration of a media file in seconds as ffprobe reports it,
+    or None if ffprobe can't read it. Raises OSError if ffprobe can't be
+    run, e.g. because it isn't installed.
+
+    """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                            capture_output = True, text = True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+def truncated(path, duration = None):
+    """
+    Returns True if ffprobe can't read the media file at path or, given the
+    duration of its playlist, finds it shorter. Raises OSError if ffprobe
+    can't be run.
+
+    """
+    probed = probe_duration(path)
+    if probed is None:
+        return True
+    return bool(duration) and probed < duration - max(TOLERANCE, duration * 0.01)
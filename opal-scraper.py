@@ -3,237 +3,793 @@
 
 import logging
 import sys
+import atexit
 import os
 import shutil
 import argparse
-import json
 import subprocess
+import threading
+import itertools
+import random
+import time
+from queue import Queue, PriorityQueue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import keyring
-from Shibboleth import Shibboleth, TUCServiceProvider, OPALServiceProvider, VCSServiceProvider
-from scraper import opal_scraper, get_m3u8, get_ts
+from store import open_store, JSONStore, SQLiteStore, JSON_FN, SQLITE_FN
+from stats import STATS, phase
+from schedule import schedule, priority, parse_size, TempBudget
+from dedup import SharekeyIndex, link_copies
+from integrity import check_segments, truncated
 
-fn = 'content.json'
+# Shibboleth, scraper and transport pull in requests, BeautifulSoup and
+# keyring. They are only imported by the commands that talk to the portals,
+# so that commands like --add stay quick.
 
-def write_content(key, val):
-    if not Path(fn).exists():
-        try:
-            f = open(fn,"w")
-            f.write("{}")
-            logging.info('Json file for content has been created')
-            f.close()
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
+# Seconds between two polls of a repository with --watch, and their jitter
+INTERVAL = 3600
+JITTER = 0.1
+
+def write_content(store, key, val):
     try:
-        with open(fn, "r") as read_file:
-            data = json.load(read_file)
-            if not "content" in data:
-                data["content"] = {key: val}
-            elif key in data["content"]:
-                logging.error("Key " + key + " is already in use.")
-                sys.exit(1)
-            else:
-                data["content"].update({key: val})
-    except Exception as e:
-        logging.error("Got unhandled exception %s" % str(e))
+        store.add_repository(key, val.pop('target'), val)
+    except KeyError as e:
+        logging.error(e.args[0])
         sys.exit(1)
-    
-    try:
-        with open(fn, "w") as write_file:
-            json.dump(data, write_file, indent = 2)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
     
 
-def write_argument(arg, val):
-    if not Path(fn).exists():
-        try:
-            f = open(fn,"w")
-            f.write("{}")
-            logging.info('Json file for content has been created')
-            f.close()
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
+def write_argument(store, arg, val):
     try:
-        with open(fn, "r") as read_file:
-            data = json.load(read_file)
-            data[arg] = val
+        store.set(arg, val)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
-    
+        
+def write_option(store, key, option, val):
     try:
-        with open(fn, "w") as write_file:
-            json.dump(data, write_file, indent = 2)
+        store.update_repository(key, **{option: val})
+    except FileNotFoundError:
+        logging.error(store.fn + " doesn't exist yet. See ./opal-scraper.py -h for help")
+        sys.exit(1)
+    except KeyError as e:
+        logging.error(e.args[0])
+        sys.exit(1)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
         
-def delete_from_json(key):
-    if not Path(fn).exists():
-        logging.ERROR(fn + "doesn't exist yet. See ./opal-scraper.py -h for help")
+def delete_from_json(store, key):
+    try:
+        store.delete_repository(key)
+    except FileNotFoundError:
+        logging.error(store.fn + " doesn't exist yet. See ./opal-scraper.py -h for help")
+        sys.exit(1)
+    except KeyError as e:
+        logging.error(e.args[0])
+        sys.exit(1)
+    except Exception as e:
+        logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
+
+def read_store(store, login = True):
+    """
+    Returns the settings and contents of the store. Exits if the store
+    doesn't exist or, if a login is needed, no user agent was set.
     
+    """
     try:
-        with open(fn, "r") as read_file:
-            data = json.load(read_file)
-            content = data['content']
-            content.pop(key)
-            data['content'].update(content)
-    except KeyError:
-        logging.error("Key " + key + " was not found in " + fn)
+        settings, contents = store.snapshot()
+    except FileNotFoundError:
+        logging.error(store.fn + " was not found. Terminating program.")
         sys.exit(1)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
-            
     
+    if login and "user-agent" not in settings:
+        logging.error("No user agent was set.")
+        sys.exit(1)
+        
+    return settings, contents
+
+def migrate():
+    """
+    Copies content.json into a new SQLite store. From then on, content.db
+    is used instead of content.json.
+    
+    """
+    if Path(SQLITE_FN).exists():
+        logging.error(SQLITE_FN + " already exists.")
+        sys.exit(1)
+    
+    source = JSONStore(JSON_FN)
+    read_store(source, login = False)
     try:
-        with open(fn, "w") as write_file:
-            json.dump(data, write_file, indent = 2)
+        SQLiteStore(SQLITE_FN).migrate(source)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
+        Path(SQLITE_FN).unlink()
         sys.exit(1)
+    
+    logging.info("Migrated %s to %s. %s is no longer used." % (JSON_FN, SQLITE_FN, JSON_FN))
 
 
-def update():
-    fn = 'content.json'
+def login(username, uagent, opal = True, session = None, stored = True):
+    """
+    Returns an authenticated Shibboleth. The session of a previous run is
+    reused as long as the service providers still accept it, otherwise the
+    whole login chain is run and the new session is stored. With session,
+    the login is made on that session instead of a new one. Without
+    stored, the keyring isn't asked for a session and none is stored.
     
-    if not Path(fn).exists():
-        logging.error(fn + " was not found. Terminating program.")
-        sys.exit(1)
-    else:
-        try:
-          with open(fn, "r") as read_file:
-                data = json.load(read_file)
-                if "user-agent" not in data.keys():
-                    logging.error("No user agent was set.")
-                    sys.exit(1)
-                else:
-                    username = data.get("username")
-                    uagent = data.get("user-agent")
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
-            
-    shib = Shibboleth()
+    """
+    from Shibboleth import Shibboleth, TUCServiceProvider, OPALServiceProvider, VCSServiceProvider
+    
+    shib = Shibboleth(session = session) if session is not None else Shibboleth()
     shib.setUser(username)
     shib._headers.update({'User-Agent': uagent})
     TUC = TUCServiceProvider(shib)
+    
+    providers = [OPALServiceProvider(shib)] if opal else []
+    providers.append(VCSServiceProvider(shib))
+    
+    if stored and shib.loadSession():
+        if logged_in(shib, opal):
+            logging.info("Reusing stored session.")
+            return shib
+        logging.info("Stored session has expired.")
+        shib.clearSession()
+    
     shib = TUC.connect()
+    for provider in providers:
+        shib = provider.connect()
+    if stored:
+        shib.saveSession()
     
-    OPAL = OPALServiceProvider(shib)
-    shib = OPAL.connect()
+    return shib
+
+def logged_in(shib, opal = True):
+    """
+    Returns True if the session of shib is still accepted by VCS and, with
+    opal, by OPAL.
     
-    VCS = VCSServiceProvider(shib)
-    shib = VCS.connect()
+    """
+    from Shibboleth import OPALServiceProvider, VCSServiceProvider
     
-    opal_scraper(shib)
+    providers = [OPALServiceProvider(shib)] if opal else []
+    providers.append(VCSServiceProvider(shib))
+    try:
+        return all(provider.probe() for provider in providers)
+    except Exception as e:
+        logging.warning("Could not check the session: %s" % str(e))
+        return False
+
+def transport_options(settings, workers, bandwidth = None):
+    import transport
+    bandwidth = bandwidth or settings.get("bandwidth")
+    return dict(timeout = settings.get("timeout", transport.TIMEOUT),
+                retries = settings.get("retries", transport.RETRIES),
+                backoff = settings.get("backoff", transport.BACKOFF),
+                rate = settings.get("rate-limit", transport.RATE),
+                bandwidth = parse_size(bandwidth) if bandwidth else None)
+
+def configure_transport(settings, workers, bandwidth = None):
+    """
+    Returns a new session with the transport settings applied. The
+    connection pool is sized to the number of workers. The requests of the
+    session are captured or replayed if --capture or --replay was given.
     
-    return 0
+    """
+    import transport
+    import capture
+    session = transport.configure(transport.TransportSession(), pool = workers, 
+                                  **transport_options(settings, workers, bandwidth))
+    if STATS.enabled:
+        STATS.instrument(session)
+    return capture.TRACE.install(session)
 
-def download():
-    fn = 'content.json'
+def session_pool(settings, workers, bandwidth = None, opal = True):
+    """
+    Logs in once and returns a pool that hands each worker thread its own
+    session with the cookies of that login. Once the login expires, it is
+    renewed on the same session by a single worker. Captures and replays
+    always run the whole login chain, so that it is part of the trace.
+    
+    """
+    from Shibboleth import SessionPool
+    import capture
     
-    if not Path(fn).exists():
-        logging.error(fn + " was not found. Terminating program.")
+    username = settings.get("username")
+    uagent = settings.get("user-agent")
+    session = configure_transport(settings, workers, bandwidth)
+    stored = capture.TRACE.mode is None
+    
+    return SessionPool(login(username, uagent, opal, session, stored),
+                       lambda: login(username, uagent, opal, session, stored),
+                       lambda shib: logged_in(shib, opal))
+
+def temp_budget(settings, contents, budget = None):
+    budget = budget or settings.get("temp-budget")
+    return TempBudget(parse_size(budget) if budget else None, contents)
+
+def async_engine():
+    """
+    Imports the asyncio engine, which depends on aiohttp.
+    
+    """
+    try:
+        import async_engine
+    except ImportError as e:
+        logging.error("The async engine is not available: %s" % str(e))
+        sys.exit(1)
+    if async_engine.aiohttp is None:
+        logging.error("The async engine needs aiohttp, install it with pip install aiohttp")
         sys.exit(1)
+    return async_engine
+
+def traced_engine(engine):
+    """
+    Returns the engine to use, the sync engine while requests are captured
+    or replayed, as the async engine doesn't send them through requests.
+    
+    """
+    import capture
+    
+    if engine == "async" and capture.TRACE.mode is not None:
+        logging.warning("The async engine can't be traced, falling back to the sync engine.")
+        return "sync"
+    return engine
+
+def update(store, workers = None, incremental = False, engine = None):
+    from scraper import opal_scraper, set_max_per_host, MAX_PER_HOST
+    
+    settings, contents = read_store(store)
+    engine = engine or settings.get("engine", "sync")
+    workers = workers or settings.get("workers", 1)
+    incremental = incremental or settings.get("incremental", False)
+    max_per_host = settings.get("max-per-host", MAX_PER_HOST)
+    set_max_per_host(max_per_host)
+    engine = traced_engine(engine)
+    
+    pool = session_pool(settings, workers)
+    
+    if engine == "async":
+        async_engine().update(pool.shib, store, incremental = incremental, workers = workers, 
+                              max_per_host = max_per_host, **transport_options(settings, workers))
     else:
-        try:
-          with open(fn, "r") as read_file:
-                data = json.load(read_file)
-                if "user-agent" not in data.keys():
-                    logging.error("No user agent was set.")
-                    sys.exit(1)
-                else:
-                    username = data.get("username")
-                    uagent = data.get("user-agent")
-                    contents = data.get("content")
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
+        opal_scraper(pool, store, workers = workers, incremental = incremental)
     
+    return 0
+
+def quality_of(settings, contents, key, quality = None):
+    """
+    Returns the quality for the media of a repository. The command line
+    wins over the setting of the repository, which wins over the global
+    setting. None keeps the variant the playlist lists last.
     
-    shib = Shibboleth()
-    shib.setUser(username)
-    shib._headers.update({'User-Agent': uagent})
-    TUC = TUCServiceProvider(shib)
-    shib = TUC.connect()
+    """
+    return quality or contents[key].get("quality") or settings.get("quality")
+
+def output_path(key, sharekey, audio = False):
+    extension = "mka" if audio else "mkv"
+    return "./{key}/{sharekey}.{extension}".format(key=key, sharekey=sharekey, extension=extension)
 
-    VCS = VCSServiceProvider(shib)
-    shib = VCS.connect()
+def deduplicate(store, index, settings, contents, key, medium, quality = None):
+    """
+    Returns True if another repository owns the medium, in which case it is
+    marked as a downloaded copy of the owner's. Copies are linked to the
+    owner's file once that has been converted. Media of repositories with
+    different qualities are not shared.
     
-    for key in contents:
-        
-        path = "./{key}".format(key=key)
+    """
+    sharekey = medium.get("sharekey")
+    owner = index.owner(key, sharekey)
+    medium_quality = quality_of(settings, contents, key, quality)
+    if owner == key or quality_of(settings, contents, owner, quality) != medium_quality:
+        return False
+    
+    logging.info("%s: %s is shared with %s" % (key, sharekey, owner))
+    if medium_quality:
+        store.update_medium(key, sharekey, downloaded = True, copy_of = owner, quality = medium_quality)
+    else:
+        store.update_medium(key, sharekey, downloaded = True, copy_of = owner)
+    return True
+
+def download(store, workers = None, resume = False, remux = False, engine = None, quality = None,
+             bandwidth = None, budget = None):
+    from scraper import set_max_per_host, MAX_PER_HOST
+    
+    settings, contents = read_store(store)
+    engine = engine or settings.get("engine", "sync")
+    workers = workers or settings.get("workers", 1)
+    max_per_host = settings.get("max-per-host", MAX_PER_HOST)
+    set_max_per_host(max_per_host)
+    resume = resume or settings.get("resume", False)
+    remux = remux or settings.get("remux", False)
+    
+    if remux and resume:
+        logging.warning("Streamed downloads can't be resumed.")
+    if remux and engine == "async":
+        logging.warning("The async engine can't remux, falling back to the sync engine.")
+        engine = "sync"
+    engine = traced_engine(engine)
+    
+    pool = session_pool(settings, workers, bandwidth, opal = False)
+    budget = temp_budget(settings, contents, budget)
+    index = SharekeyIndex(store, contents)
+    jobs = [(key, medium) for key, medium in schedule(contents)
+            if not deduplicate(store, index, settings, contents, key, medium, quality)]
+    index.save()
+    
+    for key in {key for key, medium in jobs}:
+        os.makedirs("./{key}".format(key=key), exist_ok = True)
+    
+    if engine == "async":
+        qualities = {key: quality_of(settings, contents, key, quality) for key in contents}
+        return async_engine().download(pool.shib, store, jobs, resume = resume, qualities = qualities,
+                                       budget = budget, workers = workers, 
+                                       max_per_host = max_per_host,
+                                       **transport_options(settings, workers, bandwidth))
+    
+    failed = 0
+    for key, medium in jobs:
+        if not remux and not budget.admit():
+            logging.warning("Stopped downloading, run --convert to free temp space.")
+            break
+        if not download_medium(store, pool, key, medium, workers = workers, 
+                               max_per_host = max_per_host, resume = resume, remux = remux,
+                               quality = quality_of(settings, contents, key, quality)):
+            failed += 1
+    
+    if remux:
+        link_copies(store, output_path)
+    
+    if failed:
+        logging.error("%d downloads failed, they are retried on the next run" % failed)
+    return 0 if not failed else 1
+
+def download_medium(store, shib, key, medium, workers = 1, max_per_host = None, 
+                    resume = False, remux = False, quality = None):
+    """
+    Downloads the transport streams of a medium to ./LABEL/tmp_SHAREKEY, or
+    streams them into ./LABEL/SHAREKEY.mkv with remux, and marks the medium
+    as downloaded. The quality the variant was selected with is recorded,
+    so that convert knows whether to keep the audio only, together with the
+    duration and size of the medium for the search index and its checksum
+    for --verify. The segments are recorded in the manifest of the medium
+    with their size and digest. Returns False if the download failed.
+    
+    """
+    from scraper import get_m3u8, get_ts, remux_ts, medium_metadata, MAX_PER_HOST
+    
+    sharekey = medium.get("sharekey")
+    max_per_host = max_per_host or MAX_PER_HOST
+    
+    if remux:
+        output = output_path(key, sharekey, quality == "audio")
         
         try:
-            os.mkdir(path)
-        except OSError:
-            logging.error("Creation of the directory %s failed" % path)
+            metadata = remux_ts(key, sharekey, output, shib, 
+                                workers = workers, max_per_host = max_per_host, quality = quality)
+            metadata = dict(metadata, output_size = os.path.getsize(output))
+        except Exception as e:
+            logging.error("%s: Download of %s failed: %s" % (key, sharekey, str(e)))
+            return False
+        
+    else:
+        path = "./{key}/tmp_{sharekey}".format(key=key, sharekey=sharekey)
+        
+        if resume and os.path.isdir(path):
+            logging.info("Resuming download in %s" % path)
         else:
-            logging.info("Successfully created the directory %s " % path)
+            try:
+                os.mkdir(path)
+            except OSError:
+                logging.error("Creation of the directory %s failed" % path)
+            else:
+                logging.info("Successfully created the directory %s " % path)
         
+        manifest = store.manifest(key, sharekey, path)
         
-        for idx, medium in enumerate(contents[key].get("media")):
-            
+        try:
+            get_m3u8(key, sharekey, path, shib, manifest = manifest, quality = quality)
+            get_ts(key, sharekey, path, shib,
+                   workers = workers, max_per_host = max_per_host, 
+                   manifest = manifest)
+            metadata = medium_metadata(path, sharekey, manifest)
+        except Exception as e:
+            logging.error("%s: Download of %s failed: %s" % (key, sharekey, str(e)))
+            if not resume:
+                shutil.rmtree(path, ignore_errors = True)
+            return False
+    
+    if quality:
+        metadata["quality"] = quality
+    
+    try:
+        store.update_medium(key, sharekey, downloaded = True, **metadata)
+    except Exception as e:
+        logging.error("%s: %s could not be marked as downloaded: %s" % (key, sharekey, str(e)))
+        return False
+        
+    return True
+
+
+@phase("convert")
+def convert_medium(key, sharekey, audio = False):
+    """
+    Concatenates the transport streams of a medium into an mkv file, or
+    into an mka file with the audio stream only. ffmpeg writes to a
+    temporary name that is renamed once it exited with status 0. Only then
+    the transport streams are removed. Returns False if the conversion
+    failed, also if ffmpeg couldn't be run.
+    
+    """
+    path = "./{key}".format(key=key)
+    dir_path = (path+"/tmp_{sharekey}").format(sharekey=sharekey)
+    output = output_path(key, sharekey, audio)
+    files = dir_path+"/files.txt"
+    streams = ['-vn', '-c:a', 'copy'] if audio else ['-c', 'copy']
+    
+    logging.info("%s: Convert %s" % (key, sharekey))
+    try:
+        result = subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-i', files] + 
+                                streams + ['-f', 'matroska', output+".part"])
+        
+        if result.returncode != 0:
+            logging.error("%s: ffmpeg failed for %s with status %d" % (key, sharekey, result.returncode))
+            if os.path.exists(output+".part"):
+                os.remove(output+".part")
+            return False
+        
+        os.replace(output+".part", output)
+        shutil.rmtree(dir_path)
+    except OSError as e:
+        logging.error("%s: Conversion of %s failed: %s" % (key, sharekey, str(e)))
+        return False
+    logging.info("%s: Converted %s" % (key, sharekey))
+    
+    return True
+
+def convert(store, jobs = None):
+    
+    settings, contents = read_store(store, login = False)
+    jobs = jobs or settings.get("jobs", 1)
+    
+    pending = list()
+    for key in contents:
+        path = "./{key}".format(key=key)
+        for idx, medium in enumerate(contents[key].get("media", [])):
+            if medium.get("downloaded"):
+                dir_path = (path+"/tmp_{sharekey}").format(sharekey=medium.get("sharekey"))
+                if os.path.exists(dir_path):
+                    pending.append((key, medium.get("sharekey"), medium.get("quality") == "audio"))
+    
+    with ThreadPoolExecutor(max_workers = max(jobs, 1)) as executor:
+        futures = {executor.submit(convert_medium, key, sharekey, audio): (key, sharekey, audio) 
+                   for key, sharekey, audio in pending}
+        failed = list()
+        for future in as_completed(futures):
+            if future.result():
+                record_output(store, *futures[future])
+            else:
+                failed.append(futures[future][:2])
+    
+    link_copies(store, output_path)
+    
+    logging.info("Converted %d of %d media" % (len(pending) - len(failed), len(pending)))
+    for key, sharekey in failed:
+        logging.error("%s: %s was not converted, its transport streams were kept" % (key, sharekey))
+    
+    return 0 if not failed else 1
+
+def record_output(store, key, sharekey, audio = False):
+    """
+    Records the size of a converted medium, which --verify compares with
+    the file later on.
+    
+    """
+    store.update_medium(key, sharekey, output_size = os.path.getsize(output_path(key, sharekey, audio)))
+
+def verify(store, jobs = None):
+    """
+    Checks the downloaded media against what was recorded while they were
+    downloaded, without reading the outputs. Transport streams that aren't
+    converted yet are compared with the sizes and digests in their
+    manifest. Outputs are compared with their recorded size, and only
+    those that differ, or have no recorded size yet, are probed with
+    ffprobe, up to jobs at once. Media that fail are marked as not
+    downloaded so that the next run fetches them again. Broken transport
+    streams are removed, so that --resume doesn't keep them. Without
+    ffprobe, outputs aren't probed and stay as they are. Returns 1 if a
+    medium failed or couldn't be probed.
+    
+    """
+    from scraper import parse_segments
+    
+    settings, contents = read_store(store, login = False)
+    jobs = jobs or settings.get("jobs", 1)
+    
+    checked, failed, suspects = 0, list(), list()
+    for key in contents:
+        for medium in contents[key].get("media", []):
             if not medium.get("downloaded"):
-                path = "./{key}/tmp_{sharekey}".format(key=key, sharekey=medium.get("sharekey"))
-                
+                continue
+            sharekey = medium.get("sharekey")
+            path = "./{key}/tmp_{sharekey}".format(key=key, sharekey=sharekey)
+            output = output_path(key, sharekey, medium.get("quality") == "audio")
+            checked += 1
+            
+            if os.path.isdir(path):
                 try:
-                    os.mkdir(path)
+                    with open(path + "/{sharekey}_mp4.m3u8".format(sharekey=sharekey)) as file:
+                        names = parse_segments(file.read())
                 except OSError:
-                    logging.error("Creation of the directory %s failed" % path)
-                else:
-                    logging.info("Successfully created the directory %s " % path)
-                
-                try:
-                    get_m3u8(key, medium.get("sharekey"), path, shib)
-                    get_ts(key, medium.get("sharekey"), path, shib)
-                    contents[key]["media"][idx]["downloaded"] = True
-                    data["content"].update(contents)
-                except Exception as e:
-                    logging.error("Got unhandled exception %s" % str(e))
-                    sys.exit(1)
-                
-                try:
-                    with open(fn, "w") as write_file:
-                        json.dump(data, write_file, indent = 2)
-                except Exception as e:
-                    logging.error("Got unhandled exception %s" % str(e))
-                    sys.exit(1)
-            
+                    names = None
+                broken = (check_segments(path, store.manifest(key, sharekey, path), names)
+                          if names is not None else ["{sharekey}_mp4.m3u8".format(sharekey=sharekey)])
+                if broken:
+                    logging.error("%s: %d transport streams of %s are missing or broken" 
+                                  % (key, len(broken), sharekey))
+                    for name in broken:
+                        if os.path.exists(path + "/" + name):
+                            os.remove(path + "/" + name)
+                    failed.append((key, sharekey))
+            elif os.path.exists(output):
+                if medium.get("output_size") != os.path.getsize(output):
+                    suspects.append((key, medium, output))
+            elif not medium.get("copy_of"):
+                logging.error("%s: %s is missing" % (key, output))
+                failed.append((key, sharekey))
+    
+    unprobed = 0
+    if suspects and shutil.which("ffprobe") is None:
+        logging.error("ffprobe was not found, %d outputs are not probed" % len(suspects))
+        unprobed, suspects = len(suspects), list()
+    
+    with ThreadPoolExecutor(max_workers = max(jobs, 1)) as executor:
+        futures = {executor.submit(truncated, output, medium.get("duration")): (key, medium, output)
+                   for key, medium, output in suspects}
+        for future in as_completed(futures):
+            key, medium, output = futures[future]
+            try:
+                broken = future.result()
+            except OSError as e:
+                logging.error("%s: %s could not be probed: %s" % (key, output, str(e)))
+                unprobed += 1
+                continue
+            if broken:
+                logging.error("%s: %s is truncated or unreadable" % (key, output))
+                failed.append((key, medium.get("sharekey")))
+            else:
+                store.update_medium(key, medium.get("sharekey"), output_size = os.path.getsize(output))
+    
+    for key, sharekey in failed:
+        store.update_medium(key, sharekey, downloaded = False)
+    
+    logging.info("Verified %d media, probed %d, %d failed" % (checked, len(suspects), len(failed)))
+    return 0 if not failed and not unprobed else 1
+
+def trace(store, capture_fn = None, replay_fn = None):
+    """
+    Captures the HTTP exchanges of the run to capture_fn, or replays them
+    from replay_fn instead of talking to the portals. The username is
+    redacted from captures, and the repositories of the store are kept
+    with them.
+    
+    """
+    import capture
+    
+    try:
+        settings, contents = store.snapshot()
+    except FileNotFoundError:
+        settings, contents = {}, {}
+    
+    try:
+        if capture_fn:
+            capture.TRACE.record(capture_fn, words = [settings.get("username")],
+                                 meta = {"repositories": {key: contents[key].get("target") for key in contents}})
+        else:
+            capture.TRACE.replay(replay_fn)
+    except (OSError, KeyError, ValueError) as e:
+        logging.error("%s can't be used: %s" % (capture_fn or replay_fn, str(e)))
+        sys.exit(1)
+    atexit.register(capture.TRACE.close)
+
+def show_media(media):
+    """
+    Prints one line per medium of the search index: label, sharekey,
+    duration, size, whether it was downloaded, title and course node.
+    
+    """
+    if not media:
+        logging.info("No media found.")
+        return 1
+    
+    for medium in media:
+        duration = medium["duration"]
+        duration = ("%d:%02d:%02d" % (duration // 3600, duration % 3600 // 60, duration % 60)
+                    if duration else "-")
+        size = "%.1f MB" % (medium["size"] / 1e6) if medium["size"] else "-"
+        node = " (%s)" % medium["node"] if medium["node"] else ""
+        print("%-12s %-16s %8s %10s %s %s%s" % (medium["label"], medium["sharekey"], duration, size,
+                                                "*" if medium["downloaded"] else " ",
+                                                medium["title"] or "", node))
     return 0
 
+def poll_time(settings, contents, key):
+    """
+    Returns when a repository is due to be polled again: after its own
+    "interval" in seconds or the global one, give or take the "jitter"
+    fraction of it, so that the polls of many repositories spread out.
+    
+    """
+    interval = float(contents[key].get("interval") or settings.get("interval", INTERVAL))
+    jitter = float(settings.get("jitter", JITTER))
+    return time.time() + interval * random.uniform(1 - jitter, 1 + jitter)
 
-def convert():
-    fn = 'content.json'
+def sync(store, workers = None, jobs = None, resume = False, remux = False, incremental = False, 
+         quality = None, bandwidth = None, budget = None, watch = False):
+    """
+    Runs update, download and convert as a pipeline. Media are handed to
+    the download worker as soon as their course node has been crawled, and
+    downloaded media are handed to the convert workers right away. The
+    download queue is ordered by priority, so that new media overtake the
+    backlog of previous runs. The convert queue is bounded, and while the
+    temp space exceeds the budget, downloads wait for the conversions.
     
-    if not Path(fn).exists():
-        logging.error(fn + " was not found. Terminating program.")
-        sys.exit(1)
-    else:
-        try:
-          with open(fn, "r") as read_file:
-                data = json.load(read_file)
-                contents = data.get("content")
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
+    With watch, the pipeline keeps running and polls each repository
+    whenever it is due. The session is kept and only renewed once it has
+    expired. Repositories added or deleted meanwhile are picked up, and
+    media whose download failed are retried on the next poll.
+    
+    """
+    from scraper import opal_scraper, set_max_per_host, MAX_PER_HOST
+    
+    settings, contents = read_store(store)
+    workers = workers or settings.get("workers", 1)
+    jobs = jobs or settings.get("jobs", 1)
+    max_per_host = settings.get("max-per-host", MAX_PER_HOST)
+    set_max_per_host(max_per_host)
+    resume = resume or settings.get("resume", False)
+    remux = remux or settings.get("remux", False)
+    incremental = incremental or settings.get("incremental", False)
+    
+    if remux and resume:
+        logging.warning("Streamed downloads can't be resumed.")
+    
+    pool = session_pool(settings, workers, bandwidth)
+    budget = temp_budget(settings, contents, budget)
+    
+    index = SharekeyIndex(store, contents)
+    downloads = PriorityQueue()
+    conversions = Queue(maxsize = max(jobs, 1) * 2)
+    order = itertools.count()
+    queued = set()
+    failed = list()
+    
+    def enqueue(key, medium, position = 0):
+        if (key, medium.get("sharekey")) not in queued:
+            queued.add((key, medium.get("sharekey")))
+            downloads.put((priority(contents, key, position, medium), next(order), key, medium))
+    
+    def download_job(key, medium):
+        if deduplicate(store, index, settings, contents, key, medium, quality):
+            return
+        if not remux and not budget.admit(waiting = lambda: conversions.unfinished_tasks > 0):
+            logging.warning("%s: Skipped %s, the temp space is full" % (key, medium.get("sharekey")))
+            return
+        medium_quality = quality_of(settings, contents, key, quality)
+        if not download_medium(store, pool, key, medium, workers = workers, 
+                               max_per_host = max_per_host, resume = resume, remux = remux,
+                               quality = medium_quality):
+            failed.append((key, medium.get("sharekey")))
+        elif remux:
+            link_copies(store, output_path, medium.get("sharekey"))
+        else:
+            conversions.put((key, medium.get("sharekey"), medium_quality == "audio"))
+    
+    def download_worker():
+        while True:
+            rank, n, key, medium = downloads.get()
+            if key is None:
+                break
+            queued.discard((key, medium.get("sharekey")))
+            if key not in contents:
+                continue
+            try:
+                download_job(key, medium)
+            except Exception as e:
+                logging.error("%s: Download of %s failed: %s" % (key, medium.get("sharekey"), str(e)))
+                failed.append((key, medium.get("sharekey")))
+    
+    def convert_worker():
+        while True:
+            job = conversions.get()
+            if job is None:
+                break
+            try:
+                if not convert_medium(*job):
+                    failed.append(job[:2])
+                else:
+                    record_output(store, *job)
+                    link_copies(store, output_path, job[1])
+            except Exception as e:
+                logging.error("%s: Conversion of %s failed: %s" % (job[0], job[1], str(e)))
+                failed.append(job[:2])
+            finally:
+                conversions.task_done()
+                budget.freed()
+    
+    threads = [threading.Thread(target = convert_worker) for i in range(max(jobs, 1))]
+    threads.append(threading.Thread(target = download_worker))
+    for thread in threads:
+        thread.start()
+    
+    try:
+        for key in contents:
+            os.makedirs("./{key}".format(key=key), exist_ok = True)
+            for position, medium in enumerate(contents[key].get("media", [])):
+                dir_path = "./{key}/tmp_{sharekey}".format(key=key, sharekey=medium.get("sharekey"))
+                if not medium.get("downloaded"):
+                    enqueue(key, medium, position)
+                elif os.path.exists(dir_path) and not remux:
+                    conversions.put((key, medium.get("sharekey"), medium.get("quality") == "audio"))
+        
+        opal_scraper(pool, store, workers = workers, incremental = incremental, on_media = enqueue)
+        
+        due = {key: poll_time(settings, contents, key) for key in contents}
+        while watch:
+            time.sleep(max(min(due.values(), default = time.time() + INTERVAL) - time.time(), 0))
             
-    for key in contents:
-        path = "./{key}".format(key=key)
-        for idx, medium in enumerate(contents[key].get("media")):
-            if medium.get("downloaded"):
-                dir_path = (path+"/tmp_{sharekey}").format(sharekey=medium.get("sharekey"))
-                if os.path.exists(dir_path):                           
-                    files = dir_path+"/files.txt"
-                    subprocess.run(['ffmpeg', '-f', 'concat', '-i', files, '-c', 'copy', 
-                                     (path+"/{sharekey}.mkv").format(sharekey=medium.get("sharekey"))])
-                    shutil.rmtree(dir_path)
+            fresh = store.content()
+            gone = set(contents) - set(fresh)
+            for key in gone:
+                contents.pop(key)
+                due.pop(key)
+            index.forget(gone)
+            contents.update(fresh)
+            labels = [key for key in contents if due.setdefault(key, 0) <= time.time()]
+            if not labels:
+                continue
+            
+            pool.refresh()
+            
+            for key in labels:
+                os.makedirs("./{key}".format(key=key), exist_ok = True)
+                for position, medium in enumerate(contents[key].get("media", [])):
+                    if not medium.get("downloaded"):
+                        enqueue(key, medium, position)
+            try:
+                opal_scraper(pool, store, workers = workers, incremental = incremental, 
+                             on_media = enqueue, labels = labels)
+            except Exception as e:
+                logging.error("Polling %s failed: %s" % (", ".join(labels), str(e)))
+            
+            for key in labels:
+                due[key] = poll_time(settings, contents, key)
+            index.save()
+    except KeyboardInterrupt:
+        logging.info("Interrupted, finishing the current downloads and conversions.")
+        while not downloads.empty():
+            downloads.get_nowait()
+    finally:
+        downloads.put(((float("inf"),), next(order), None, None))
+        threads[-1].join()
+        for thread in threads[:-1]:
+            conversions.put(None)
+        for thread in threads[:-1]:
+            thread.join()
+        index.save()
+    
+    link_copies(store, output_path)
+    
+    for key, sharekey in failed:
+        logging.error("%s: %s failed, it is retried on the next run" % (key, sharekey))
+    
+    return 0 if not failed else 1
     
 if __name__ == '__main__':
         
@@ -251,10 +807,77 @@ if __name__ == '__main__':
     group.add_argument("--update", help="update contents", action="store_true")
     group.add_argument("--download", help="download contents", action="store_true")
     group.add_argument("--convert", help="Convert transport streams", action="store_true")
+    group.add_argument("--sync", help="update, download and convert contents in one pipeline", 
+                       action="store_true")
+    group.add_argument("--watch", help="keep running and sync each repository whenever it is due", 
+                       action="store_true")
+    group.add_argument("--migrate", help="move contents from content.json to a SQLite database", 
+                       action="store_true")
+    group.add_argument("--set-quality", help="set the quality of all repositories, or of LABEL", 
+                       type=str, nargs="+", metavar=('QUALITY', 'LABEL'))
+    group.add_argument("--set-interval", help="set the seconds between two polls with --watch of all "
+                       "repositories, or of LABEL (default: %d)" % INTERVAL, 
+                       type=str, nargs="+", metavar=('SECONDS', 'LABEL'))
+    group.add_argument("--set-priority", help="set the priority of LABEL, higher is downloaded first (default: 1)", 
+                       type=str, nargs=2, metavar=('LABEL', 'PRIORITY'))
+    group.add_argument("--verify", help="check downloaded media against their recorded sizes and checksums", 
+                       action="store_true")
+    group.add_argument("--search", help="list the media whose title, course node or label match QUERY", 
+                       type=str, metavar=('QUERY'))
+    group.add_argument("--list", help="list the media of LABEL", type=str, metavar=('LABEL'))
     
+    parser.add_argument("--workers", help="number of concurrent requests for --update and --download", 
+                        type=int, metavar=('N'))
+    
+    parser.add_argument("-j", "--jobs", help="number of concurrent ffmpeg jobs for --convert and ffprobe jobs for --verify", 
+                        type=int, metavar=('N'))
+    parser.add_argument("--resume", help="resume interrupted downloads", action="store_true")
+    parser.add_argument("--remux", help="remux videos into mkv files while downloading", 
+                        action="store_true")
+    parser.add_argument("--stats", help="log request and phase statistics at the end, "
+                        "and write them to FILE (JSON, or Prometheus textfile if FILE ends with .prom)", 
+                        nargs="?", const=True, metavar=('FILE'))
+    parser.add_argument("--engine", help="engine for --update and --download (default: sync)", 
+                        choices=["sync", "async"])
+    parser.add_argument("--incremental", help="only parse course nodes that changed since the last update", 
+                        action="store_true")
+    parser.add_argument("--quality", help="variant to download: max, min, audio or a height like 720p. "
+                        "Stored with the repository for --add", type=str, metavar=('QUALITY'))
+    parser.add_argument("--bandwidth", help="cap the download bandwidth to RATE bytes per second, "
+                        "e.g. 5M", type=str, metavar=('RATE'))
+    parser.add_argument("--capture", help="record all requests and responses, without credentials, "
+                        "to the archive FILE", type=str, metavar=('FILE'))
+    parser.add_argument("--replay", help="serve the responses of the archive FILE, with their original "
+                        "timing, instead of sending requests", type=str, metavar=('FILE'))
+    parser.add_argument("--temp-budget", help="pause downloads while the transport streams take more "
+                        "than SIZE, e.g. 20G", type=str, metavar=('SIZE'))
     
     args = parser.parse_args()
     
+    try:
+        for quality in [args.quality] + (args.set_quality or [])[:1]:
+            if quality is not None:
+                from scraper import check_quality
+                check_quality(quality)
+    except ValueError as e:
+        parser.error(e.args[0])
+    if args.set_quality and len(args.set_quality) > 2:
+        parser.error("--set-quality takes QUALITY and an optional LABEL")
+    try:
+        for size in (args.bandwidth, args.temp_budget):
+            if size is not None:
+                parse_size(size)
+        if args.set_priority:
+            float(args.set_priority[1])
+        if args.set_interval and float(args.set_interval[0]) <= 0:
+            raise ValueError("The interval has to be positive")
+    except ValueError as e:
+        parser.error(e.args[0])
+    if args.set_interval and len(args.set_interval) > 2:
+        parser.error("--set-interval takes SECONDS and an optional LABEL")
+    if args.capture and args.replay:
+        parser.error("--capture and --replay can't be combined")
+    
     root = logging.getLogger()
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.DEBUG)
@@ -279,35 +902,93 @@ if __name__ == '__main__':
     
     handler.setFormatter(formatter)
     root.addHandler(handler)
+    
+    # Only commands that read or change media need the search index
+    store = open_store(indexed = any((args.update, args.download, args.convert, args.sync, args.watch,
+                                      args.verify, args.delete, args.search, args.list)))
+    
+    if args.stats:
+        # Sessions made from now on are instrumented, see configure_transport
+        STATS.enabled = True
+        
+        def report():
+            STATS.summary()
+            if args.stats is not True:
+                STATS.write(args.stats)
+        
+        # Report also if a command exits early
+        atexit.register(report)
+    
+    if args.capture or args.replay:
+        trace(store, args.capture, args.replay)
 
     if args.user:
         logging.info("Set username and password.")
-        write_argument("username", args.user[0])
+        write_argument(store, "username", args.user[0])
+        import keyring
         keyring.set_password("system", args.user[0], args.user[1])
         
     if args.uagent:
         logging.info("Set user agent.")
-        write_argument("user-agent", args.uagent)
+        write_argument(store, "user-agent", args.uagent)
 
     if args.add:
         logging.info("Add " + args.add[0] + " to contents.")
         label = args.add[0]
         target = {'target': args.add[1]}
-        write_content(label,  target)
+        if args.quality:
+            target['quality'] = args.quality
+        write_content(store, label,  target)
         
     if args.delete:
         logging.info("Remove " + args.delete + ' from contents')
-        delete_from_json(args.delete)
+        delete_from_json(store, args.delete)
         
     if args.update:
         logging.info("Update contents...")
-        update()
+        update(store, args.workers, args.incremental, args.engine)
     if args.download:
         logging.info("Download contents...")
-        download()
+        sys.exit(download(store, args.workers, args.resume, args.remux, args.engine, args.quality, 
+                          args.bandwidth, args.temp_budget))
     if args.convert:
         logging.info("Convert videos")
-        convert()
+        sys.exit(convert(store, args.jobs))
+    if args.sync:
+        logging.info("Sync contents...")
+        sys.exit(sync(store, args.workers, args.jobs, args.resume, args.remux, args.incremental, 
+                      args.quality, args.bandwidth, args.temp_budget))
+    if args.watch:
+        logging.info("Watch contents...")
+        sys.exit(sync(store, args.workers, args.jobs, args.resume, args.remux, args.incremental, 
+                      args.quality, args.bandwidth, args.temp_budget, watch = True))
+    if args.migrate:
+        logging.info("Migrate contents to SQLite")
+        migrate()
+    if args.set_quality:
+        if len(args.set_quality) == 2:
+            logging.info("Set quality of %s to %s." % (args.set_quality[1], args.set_quality[0]))
+            write_option(store, args.set_quality[1], "quality", args.set_quality[0])
+        else:
+            logging.info("Set quality to %s." % args.set_quality[0])
+            write_argument(store, "quality", args.set_quality[0])
+    if args.set_interval:
+        if len(args.set_interval) == 2:
+            logging.info("Set interval of %s to %s s." % (args.set_interval[1], args.set_interval[0]))
+            write_option(store, args.set_interval[1], "interval", float(args.set_interval[0]))
+        else:
+            logging.info("Set interval to %s s." % args.set_interval[0])
+            write_argument(store, "interval", float(args.set_interval[0]))
+    if args.set_priority:
+        logging.info("Set priority of %s to %s." % tuple(args.set_priority))
+        write_option(store, args.set_priority[0], "priority", float(args.set_priority[1]))
+    if args.verify:
+        logging.info("Verify contents...")
+        sys.exit(verify(store, args.jobs))
+    if args.search:
+        show_media(store.index.search(args.search))
+    if args.list:
+        show_media(store.index.media(args.list))
 
     
     if len(sys.argv) == 1:
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import logging
+import os
+import threading
+
+# Seconds between two looks at the temp space while waiting for conversions
+POLL = 30
+
+_sizes = {"": 1, "k": 1e3, "m": 1e6, "g": 1e9, "t": 1e12}
+
+def parse_size(size):
+    """
+    Returns the number of bytes of a size like 500M or 2G. Plain numbers
+    are bytes. Raises ValueError for anything else.
+
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    number, unit = size.strip()[:-1], size.strip()[-1:].lower()
+    if unit.isdigit() or unit == ".":
+        number, unit = size.strip(), ""
+    if unit not in _sizes:
+        raise ValueError("Invalid size %s, use bytes or a number with K, M, G or T" % size)
+    return int(float(number) * _sizes[unit])
+
+def priority(contents, key, position, medium):
+    """
+    Sort key of a medium. Repositories with a higher "priority" come first,
+    and within the same priority the newest media, that is the ones added
+    last, or listed last by their repository if they have no timestamp.
+
+    """
+    return (-float(contents[key].get("priority", 1)), -medium.get("added", 0), -position)
+
+def schedule(contents, pending = None):
+    """
+    Returns (key, medium) for all media that pending accepts, by default
+    those that aren't downloaded yet, in the order they should be
+    downloaded.
+
+    """
+    pending = pending or (lambda medium: not medium.get("downloaded"))
+    jobs = [(priority(contents, key, position, medium), key, medium)
+            for key in contents
+            for position, medium in enumerate(contents[key].get("media", []))
+            if pending(medium)]
+    return [(key, medium) for rank, key, medium in sorted(jobs, key = lambda job: job[0])]
+
+
+class TempBudget:
+    """
+    Byte budget for the transport streams in the LABEL/tmp_SHAREKEY
+    directories. New downloads are only admitted while the temp space in
+    use is below the budget. A budget of None admits everything. labels
+    may be a dict that changes while the budget is in use.
+
+    """
+
+    def __init__(self, budget, labels):
+        self.budget = budget
+        self.labels = labels
+        self._freed = threading.Condition()
+
+    def usage(self):
+        size = 0
+        for label in list(self.labels):
+            for path in glob.glob(os.path.join(glob.escape(label), "tmp_*")):
+                for root, dirs, files in os.walk(path):
+                    for name in files:
+                        try:
+                            size += os.path.getsize(os.path.join(root, name))
+                        except OSError:
+                            pass
+        return size
+
+    def admit(self, waiting = None):
+        """
+        Returns True if a new download fits into the budget. As long as
+        waiting returns True, e.g. because conversions are still pending,
+        it waits for space to be freed instead of returning False.
+
+        """
+        if self.budget is None:
+            return True
+
+        with self._freed:
+            while True:
+                usage = self.usage()
+                if usage < self.budget:
+                    return True
+                if waiting is None or not waiting():
+                    logging.warning("Temp space of %.1f MB exceeds the budget of %.1f MB."
+                                    % (usage / 1e6, self.budget / 1e6))
+                    return False
+                logging.info("Temp space of %.1f MB exceeds the budget, waiting for conversions."
+                             % (usage / 1e6))
+                self._freed.wait(POLL)
+
+    def freed(self):
+        with self._freed:
+            self._freed.notify_all()
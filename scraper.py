@@ -1,149 +1,443 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from bs4 import BeautifulSoup
+from extract import find_attr, find_all_attr, input_value
+from integrity import file_digest, medium_checksum
+from stats import phase
+import transport
 import logging
 import re
+import os
 import sys
-from pathlib import Path
-import json
+import hashlib
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 
+# Upper bound of requests in flight to a single host, regardless of workers,
+# and the number the adaptive limit starts with
+MAX_PER_HOST = 16
+START_PER_HOST = 4
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+_max_per_host = MAX_PER_HOST
+
+def set_max_per_host(limit):
+    """
+    Sets the upper bound of requests in flight per host, usually to the
+    "max-per-host" setting, for the hosts seen so far and all others.
+    
+    """
+    global _max_per_host
+    with _host_slots_lock:
+        _max_per_host = limit
+        for slot in _host_slots.values():
+            slot.cap(limit)
+
+def host_slot(url, limit = None):
+    """
+    Returns the adaptive limit of concurrent requests to the host of url,
+    see transport.AdaptiveLimit. It starts at START_PER_HOST and never
+    exceeds limit, by default the one of set_max_per_host.
+    
+    """
+    host = urlparse(url).netloc
+    limit = limit or _max_per_host
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = transport.AdaptiveLimit(host, min(START_PER_HOST, limit), limit)
+        elif _host_slots[host].maximum != limit:
+            _host_slots[host].cap(limit)
+        return _host_slots[host]
+
+def get_page(shib, url, headers = None):
+    """
+    GET request that respects the per-host limit of concurrent requests
+    and adjusts it to the response.
+    
+    """
+    with host_slot(url) as slot:
+        return slot.call(shib.session.get, url, headers = headers)
+
+def drive(steps, fetch):
+    """
+    Runs a generator like node_media that yields (url, headers) for every
+    page it needs. Each response of fetch, or the exception it raised, is
+    sent back into the generator. Returns the return value of the generator.
+    
+    """
+    response, error = None, None
+    while True:
+        try:
+            request = steps.throw(error) if error else steps.send(response)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            response, error = fetch(*request), None
+        except Exception as e:
+            response, error = None, e
+
+_default_ports = {"http": 80, "https": 443}
+
+def normalize_url(url):
+    """
+    Returns url with lower case scheme and host, without default port and
+    fragment, and with sorted query parameters, so that URLs of the same
+    page compare equal.
+    
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != _default_ports.get(scheme):
+        netloc += ":%d" % parts.port
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values = True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class Frontier:
+    """
+    Memory of a single crawl that is shared by all repositories. It knows
+    which course nodes were queued already, the pages of OPAL iframes and
+    what the VCS pages resolve to, each by normalized URL. Only successful
+    responses are remembered.
+    
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._visited = set()
+        self._pages = dict()
+        self._resolved = dict()
+        self.hits = 0
+    
+    def visit(self, url):
+        """
+        Returns True if url is visited for the first time.
+        
+        """
+        url = normalize_url(url)
+        with self._lock:
+            if url in self._visited:
+                return False
+            self._visited.add(url)
+            return True
+    
+    def _get(self, cache, url):
+        with self._lock:
+            val = cache.get(normalize_url(url))
+            if val is not None:
+                self.hits += 1
+            return val
+    
+    def page(self, url):
+        return self._get(self._pages, url)
+    
+    def add_page(self, url, text):
+        with self._lock:
+            self._pages[normalize_url(url)] = text
+    
+    def resolved(self, url):
+        """
+        Returns (sharekey, title, links) of a VCS page, links being the
+        videocampus links on the page, or None if it wasn't resolved yet.
+        
+        """
+        return self._get(self._resolved, url)
+    
+    def resolve(self, url, sharekey, title, links = None):
+        with self._lock:
+            self._resolved[normalize_url(url)] = (sharekey, title, links)
+
+
+def parse_course_nodes(c):
+    p = re.compile("\"href\"\:\"(.*?)\"\,\"title\"\:\"(.*?)\"")
+    return p.findall(c)
+
+@phase("get_course_nodes")
 def get_course_nodes(shib, url):
     """
     BeautifulSoup can't parse JavaScript and RegEx is needed to extract
     links to course nodes.
 
     """
-    response =  shib.session.get(url)    
+    response =  get_page(shib, url)    
     c = response.text
-    p = re.compile("\"href\"\:\"(.*?)\"\,\"title\"\:\"(.*?)\"")
-    course_nodes = p.findall(c)
+    course_nodes = parse_course_nodes(c)
     
     return course_nodes
 
-def get_media(course_nodes, shib, src):
+def node_media(node, src, fingerprint = None, frontier = None):
     """
     To download the video, we need the sharekey. The sharekey is in
     
     1. the url, if the video is embedded in the page
     2. inside an input tag on the VCS page
+    
+    Each medium also records the title and URL of its course node.
+    
+    Given the fingerprint of the last run, the node page is requested
+    conditionally. If neither it nor the page of its iframe changed, the
+    media found back then are returned without parsing the pages or
+    following their links. Given a frontier, iframes and VCS pages that
+    were seen before during the crawl are taken from it instead of being
+    requested again.
+    
+    This is a generator that doesn't do any I/O itself, see drive. It
+    returns the media and the new fingerprint of the node page, which is
+    None if the node page or one of the pages it links to couldn't be
+    fetched, so that the node is crawled again on the next run.
         
     """
     
     media = list()
+    videocampus = re.compile("videocampus")
+    complete = True
     
-    for node in course_nodes:
-        iframeSrc = None
-        response = shib.session.get(node[0])
-        c = response.text
-        
-        soup = BeautifulSoup(c, 'html.parser')
-        
+    def fetch(url):
+        nonlocal complete
         try:
-            """
-            Some video URLs are not offered in a list, but on a page 
-            that is included as an iframe.
-            """
-            
-            iframeSrc = soup.find('iframe').get('src')
-            response = shib.session.get(src[0:33]+iframeSrc)
-            c = response.text
-            soup = BeautifulSoup(c, 'html.parser')
+            response = yield url, None
         except Exception:
-            """
-            TODO: Implement error handling
-            """
-            pass
+            complete = False
+            raise
+        complete = complete and response.ok
+        return response
+    
+    iframeSrc = None
+    iframe = None
+    headers = {}
+    if fingerprint and fingerprint.get("etag"):
+        headers['If-None-Match'] = fingerprint["etag"]
+    if fingerprint and fingerprint.get("last-modified"):
+        headers['If-Modified-Since'] = fingerprint["last-modified"]
+    
+    response = node_response = yield node[0], headers
+    c = response.text
+    
+    if fingerprint and response.status_code == 304:
+        digest = fingerprint.get("hash")
+    else:
+        digest = hashlib.sha256(c.encode()).hexdigest()
+    unchanged = bool(fingerprint) and digest is not None and fingerprint.get("hash") == digest
+    if unchanged and not fingerprint.get("iframe"):
+        logging.debug("Course node %s is unchanged" % node[0])
+        return fingerprint.get("media", []), fingerprint
+    
+    try:
+        """
+        Some video URLs are not offered in a list, but on a page 
+        that is included as an iframe.
+        """
         
-        try:
-            """
-            iframe can have another iframe embedded that contains the embedded media.
-            iframe source contains the sharekey
+        if unchanged:
+            url = fingerprint["iframe"]["url"]
+        else:
+            iframeSrc = find_attr(c, 'iframe', 'src')
+            url = src[0:33]+iframeSrc
+        page = frontier.page(url) if frontier else None
+        if page is None:
+            response = yield from fetch(url)
+            page = response.text
+            if frontier and response.ok:
+                frontier.add_page(url, page)
+        iframe = {"url": url, "hash": hashlib.sha256(page.encode()).hexdigest()}
+        c = page
+    except Exception:
+        """
+        TODO: Implement error handling
+        """
+        pass
+    
+    if unchanged and (iframe == fingerprint["iframe"] or not complete):
+        logging.debug("Course node %s is unchanged" % node[0])
+        return fingerprint.get("media", []), fingerprint
+    
+    links = None
+    try:
+        """
+        iframe can have another iframe embedded that contains the embedded media.
+        iframe source contains the sharekey
+        """
+        
+        p = re.compile('embed\?key\=([A-Za-z0-9]+)')
+        for embedded_media in find_all_attr(c, 'iframe', 'src'):
+            sharekey = p.findall(embedded_media)
+            resolved = frontier.resolved(embedded_media) if frontier else None
+            if resolved is None:
+                response = yield from fetch(embedded_media)
+                title = find_attr(response.text, 'video', 'data-piwik-title')
+                resolved = (sharekey[0], title, find_all_attr(response.text, "a", "href", pattern = videocampus))
+                if frontier and response.ok:
+                    frontier.resolve(embedded_media, *resolved)
+            links = resolved[2]
+            media_dict = {'title': resolved[1],
+                          'sharekey': sharekey[0],
+                          'type': 'video',
+                          'node': node[1],
+                          'node_url': node[0]
+                }
+            media.append(media_dict)
+    except Exception:
+        """
+        TODO: Implement error handling
+        """
+        pass
+        
+        
+    try:
+        if links is None:
+            links = find_all_attr(c, "a", "href", pattern = videocampus)
+        for url in links:
             """
+            If there is no embedded video, there are probably links
+            to the medium hosted on Videocampus Sachsen
             
-            p = re.compile('embed\?key\=([A-Za-z0-9]+)')
-            for iframe in soup.find_all('iframe'):
-                embedded_media = iframe.get('src')
-                sharekey = p.findall(embedded_media)
-                response = shib.session.get(embedded_media)
-                c = response.text
-                soup = BeautifulSoup(c, 'html.parser')
-                title = soup.find('video').get('data-piwik-title')
-                media_dict = {'title': title,
-                              'sharekey': sharekey[0],
-                              'type': 'video'
-                    }
-                media.append(media_dict)
-        except Exception:
-            """
-            TODO: Implement error handling
             """
-            pass
             
+            resolved = frontier.resolved(url) if frontier else None
+            if resolved is None:
+                response = yield from fetch(url)
+                resolved = (input_value(response.text, 'sharekey'), 
+                            find_attr(response.text, 'video', 'data-piwik-title'))
+                if frontier and response.ok:
+                    frontier.resolve(url, *resolved)
+            sharekey, title = resolved[:2]
             
-        try:
-            for link in soup.find_all("a", href=re.compile("videocampus")):
-                """
-                If there is no embedded video, there are probably links
-                to the medium hosted on Videocampus Sachsen
-                
-                """
-                
-                url = link.get("href")
-                response = shib.session.get(url)
-                c = response.text
-                soup = BeautifulSoup(c, 'html.parser')
-                sharekey = soup.find('input', {'name':'sharekey'}).get('value')
-                title = soup.find('video').get('data-piwik-title')
-                
-                media_dict = {
-                    "title": title,
-                    'sharekey': sharekey,
-                    "type": 'video',
-                    "downloaded": False
-                    }
-                media.append(media_dict)
-        except Exception:
-            """
-            TODO: Implement error handling
-            """
-            pass
+            if sharekey is None:
+                continue
             
+            media_dict = {
+                "title": title,
+                'sharekey': sharekey,
+                "type": 'video',
+                "node": node[1],
+                "node_url": node[0],
+                "downloaded": False
+                }
+            media.append(media_dict)
+    except Exception:
+        """
+        TODO: Implement error handling
+        """
+        pass
+    
+    if node_response.status_code == 304:
+        etag, modified = fingerprint.get("etag"), fingerprint.get("last-modified")
+    else:
+        etag, modified = node_response.headers.get('ETag'), node_response.headers.get('Last-Modified')
+    
+    fingerprint = None
+    if node_response.ok and complete:
+        fingerprint = {
+            "etag": etag,
+            "last-modified": modified,
+            "hash": digest,
+            "iframe": iframe,
+            "media": media
+            }
+        
+    return media, fingerprint
+
+@phase("get_media")
+def get_node_media(node, shib, src, fingerprints = None, frontier = None):
+    """
+    Returns the media of a course node, see node_media. If fingerprints is
+    given, the fingerprint of the node is read from and stored in it. The
+    fingerprint of a node that couldn't be crawled completely is dropped.
+    
+    """
+    fingerprint = fingerprints.get(node[0]) if fingerprints is not None else None
+    media, fingerprint = drive(node_media(node, src, fingerprint, frontier),
+                               lambda url, headers: get_page(shib, url, headers = headers))
+    
+    if fingerprints is not None:
+        if fingerprint is None:
+            fingerprints.pop(node[0], None)
+        else:
+            fingerprints[node[0]] = fingerprint
+        
     return media
 
-def opal_scraper(shib):
+def opal_scraper(shib, store, workers = 1, incremental = False, on_media = None, labels = None):
+    """
+    Crawls all repositories, or those in labels, for new media and adds
+    them to the store. With on_media, the media of each course node are
+    added as soon as the node has been crawled and on_media(key, medium)
+    is called for each new one.
     
-    fn = 'content.json'
+    """
     
-    if not Path(fn).exists():
-        logging.error(fn + " was not found. Terminating program.")
+    try:
+        content = store.content()
+        if labels is not None:
+            content = {key: content[key] for key in labels if key in content}
+        fingerprints = store.get("fingerprints", {}) if incremental else None
+    except Exception as e:
+        logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
-    else:
-        try:
-          with open(fn, "r") as read_file:
-                data = json.load(read_file)
-                content = data.get("content")
-        except Exception as e:
-            logging.error("Got unhandled exception %s" % str(e))
-            sys.exit(1)
-            
     
-    """
-    TODO:
-        - Check if video is already in there
-    """
-            
-    for key in content:
+    def crawl_repository(key):
         d = content.get(key)
         logging.info("Checking for content for " + key)
-        course_nodes = get_course_nodes(shib, d.get("target"))
-        media = get_media(course_nodes, shib, d.get("target"))
-        content[key]["media"] = media
+        return get_course_nodes(shib, d.get("target"))
+    
+    frontier = Frontier()
+    
+    def crawl_node(job):
+        key, node = job
+        return node, get_node_media(node, shib, content[key].get("target"), fingerprints, frontier)
     
-    data["content"].update(content)
+    """
+    The course nodes of all repositories are collected first, so that a
+    single pool of workers can be spread over the nodes of all repositories.
+    A course node that several repositories list is crawled once for all.
+    """
+    
+    with ThreadPoolExecutor(max_workers = max(workers, 1)) as executor:
+        course_nodes = dict(zip(content, executor.map(crawl_repository, content)))
+        jobs = [(key, node) for key in content for node in course_nodes[key]]
+        
+        listed = dict()
+        unique = list()
+        for key, node in jobs:
+            if frontier.visit(node[0]):
+                listed[normalize_url(node[0])] = [key]
+                unique.append((key, node))
+            elif key not in listed[normalize_url(node[0])]:
+                listed[normalize_url(node[0])].append(key)
+        
+        found = {key: list() for key in content}
+        crawled = dict()
+        for node, media in executor.map(crawl_node, unique):
+            crawled[normalize_url(node[0])] = media
+            if on_media is None:
+                continue
+            for key in listed[normalize_url(node[0])]:
+                for medium in store.add_media(key, media):
+                    found[key].append(medium)
+                    on_media(key, medium)
+        
+        if on_media is None:
+            for key, node in jobs:
+                found[key].extend(crawled[normalize_url(node[0])])
+    
+    logging.debug("Crawled %d of %d course nodes, %d pages were known already" 
+                  % (len(unique), len(jobs), frontier.hits))
     
     try:
-        with open(fn, "w") as write_file:
-            json.dump(data, write_file, indent = 2)
+        for key in content:
+            added = found[key] if on_media is not None else store.add_media(key, found[key])
+            logging.info("%s: Found %d new media" % (key, len(added)))
+        
+        if incremental and labels is None:
+            # Forget course nodes that have been removed from their repository
+            nodes = {node[0] for key, node in jobs}
+            store.set("fingerprints", {url: fingerprints[url] for url in fingerprints if url in nodes})
+        elif incremental:
+            store.set("fingerprints", fingerprints)
     except Exception as e:
         logging.error("Got unhandled exception %s" % str(e))
         sys.exit(1)
@@ -151,42 +445,222 @@ def opal_scraper(shib):
     return 0
 
 
-def download_file(url, path, shib):
-    with shib.session.get(url, stream=True) as r:
+QUALITIES = ("max", "min", "audio")
+
+_attribute_list = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_video_codecs = ("avc", "hvc", "hev", "vp08", "vp09", "av01", "mp4v")
+
+def check_quality(quality):
+    """
+    Returns quality if it is a valid selection policy: max, min, audio or
+    a height like 720p. Raises ValueError otherwise.
+    
+    """
+    if quality not in QUALITIES and not re.fullmatch(r"\d+p", quality or ""):
+        raise ValueError("Invalid quality %s, use max, min, audio or a height like 720p" % quality)
+    return quality
+
+def parse_attributes(line):
+    """
+    Returns the attribute list of a playlist tag as a dict.
+    
+    """
+    return {name: val.strip('"') for name, val in _attribute_list.findall(line.partition(":")[2])}
+
+def parse_variants(c):
+    """
+    Returns the variants of a master playlist in playlist order, as dicts
+    with the URI, the bandwidth, the height and whether the variant only
+    carries audio. Audio renditions of #EXT-X-MEDIA tags with their own URI
+    count as audio-only variants.
+    
+    """
+    variants = list()
+    attributes = None
+    
+    for line in (line.strip() for line in c.splitlines()):
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = parse_attributes(line)
+        elif line.startswith("#EXT-X-MEDIA:"):
+            media = parse_attributes(line)
+            if media.get("TYPE") == "AUDIO" and media.get("URI"):
+                variants.append({"uri": media["URI"], "bandwidth": int(media.get("BANDWIDTH", 0) or 0),
+                                 "height": None, "audio": True})
+        elif line and not line.startswith("#") and attributes is not None:
+            resolution = attributes.get("RESOLUTION", "")
+            codecs = attributes.get("CODECS", "").lower()
+            video = "x" in resolution or any(codec in codecs for codec in _video_codecs)
+            variants.append({"uri": line, "bandwidth": int(attributes.get("BANDWIDTH", 0) or 0),
+                             "height": int(resolution.partition("x")[2]) if "x" in resolution else None,
+                             "audio": bool(codecs) and not video})
+            attributes = None
+    
+    return variants
+
+def select_variant(variants, quality):
+    """
+    Picks a variant according to quality. max and min pick the highest and
+    lowest video variant, a height like 720p the best one that isn't
+    higher, or the lowest if all are. audio picks the leanest audio-only
+    variant, or the leanest variant at all if there is none.
+    
+    """
+    video = sorted((v for v in variants if not v["audio"]) or variants,
+                   key = lambda v: (v["height"] or 0, v["bandwidth"]))
+    
+    if quality == "max":
+        return video[-1]
+    if quality == "min":
+        return video[0]
+    if quality == "audio":
+        audio = [v for v in variants if v["audio"]] or variants
+        return min(audio, key = lambda v: v["bandwidth"])
+    
+    height = int(quality[:-1])
+    fitting = [v for v in video if v["height"] is not None and v["height"] <= height]
+    return fitting[-1] if fitting else video[0]
+
+def parse_master(c, quality = None):
+    """
+    Returns the URI of the variant to download from a master playlist.
+    Without a quality, this is the last variant of the playlist.
+    
+    """
+    variants = parse_variants(c)
+    if quality is None or not variants:
+        lines = [line.rstrip() for line in c.splitlines() if line.strip()]
+        return lines[-1]
+    
+    variant = select_variant(variants, quality)
+    logging.debug("Selected variant %s for quality %s" % (variant["uri"], quality))
+    return variant["uri"]
+
+def parse_segments(c):
+    """
+    Returns the segment URIs of a media playlist in playlist order.
+    
+    """
+    return [x for x in (line.rstrip() for line in c.splitlines()) if x and "EXT" not in x]
+
+def parse_duration(c):
+    """
+    Returns the duration of a media playlist in seconds, the sum of the
+    durations of its segments.
+    
+    """
+    duration = 0.0
+    for line in c.splitlines():
+        if line.startswith("#EXTINF:"):
+            try:
+                duration += float(line[8:].partition(",")[0])
+            except ValueError:
+                pass
+    return duration
+
+def medium_metadata(path, sharekey, manifest = None):
+    """
+    Returns the duration, the size in bytes and, given the manifest the
+    segments were recorded in, the checksum of the transport streams of a
+    medium downloaded to path.
+    
+    """
+    with open(path + "/{sharekey}_mp4.m3u8".format(sharekey=sharekey)) as file:
+        c = file.read()
+    ts_keys = parse_segments(c)
+    size = sum(os.path.getsize(path + "/" + tkey) for tkey in ts_keys
+               if os.path.exists(path + "/" + tkey))
+    metadata = {"duration": parse_duration(c), "size": size}
+    if manifest is not None:
+        metadata["checksum"] = medium_checksum([manifest.digests.get(tkey) for tkey in ts_keys])
+    return metadata
+
+def download_file(url, path, shib, resume = False):
+    """
+    Downloads url to path and returns the size and the SHA-256 digest of
+    the file. The digest is computed while the chunks are written, so the
+    file is never read again. With resume, an existing partial file is
+    continued with a HTTP Range request. If the server ignores the range,
+    the file is downloaded from scratch. A response that ends before its
+    Content-Length raises an IOError. The response adjusts the per-host
+    limit of concurrent requests, whose slot the caller holds.
+    
+    """
+    headers = {}
+    if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+        headers['Range'] = "bytes=%d-" % os.path.getsize(path)
+    
+    with host_slot(url).call(shib.session.get, url, stream=True, headers=headers) as r:
+        if headers and r.status_code == 416:
+            # The partial file already has the full length
+            return os.path.getsize(path), file_digest(path).hexdigest()
         r.raise_for_status()
-        with open(path, 'wb') as f:
+        if r.status_code == 206:
+            mode, digest = 'ab', file_digest(path)
+        else:
+            mode, digest = 'wb', hashlib.sha256()
+        received = 0
+        with open(path, mode) as f:
             for chunk in r.iter_content(chunk_size=8192):
+                transport.throttle(shib.session, len(chunk))
+                digest.update(chunk)
                 f.write(chunk)
-    return 0
+                received += len(chunk)
+        expected = r.headers.get('Content-Length')
+        if expected is not None and 'Content-Encoding' not in r.headers and received != int(expected):
+            raise IOError("Got %d of %s bytes for url: %s" % (received, expected, url))
+    return os.path.getsize(path), digest.hexdigest()
 
-def get_m3u8(key, sharekey, path, shib):
+def fetch_file(name, url, path, shib, manifest = None):
+    """
+    Downloads a file of a medium. Files the manifest knows to be complete
+    are skipped, unfinished ones are resumed. Finished files are recorded
+    in the manifest with their size and digest.
+    
+    """
+    file_path = path + "/" + name
+    if manifest is None:
+        download_file(url, file_path, shib)
+    elif not manifest.complete(name, file_path):
+        manifest.add(name, *download_file(url, file_path, shib, resume = True))
+    return file_path
+
+@phase("get_m3u8")
+def get_m3u8(key, sharekey, path, shib, manifest = None, quality = None):
     
     
     logging.info("%s: Download m3u8 for %s" % (key, sharekey))
     m3u8_url = "https://videocampus.sachsen.de/media/hlsMedium/key/{sharekey}/format/auto/ext/mp4/learning/0/path/m3u8".format(sharekey=sharekey)
-    m3u8_path = path + "/{sharekey}.m3u8".format(sharekey=sharekey)
-    download_file(m3u8_url, m3u8_path, shib)
+    m3u8_path = fetch_file("{sharekey}.m3u8".format(sharekey=sharekey), 
+                           m3u8_url, path, shib, manifest)
     
     with open(m3u8_path) as file:
-        lines = [line.rstrip() for line in file]
+        variant = parse_master(file.read(), quality)
 
-    m3u8mp4_url = (m3u8_url[0:-4]+lines[-1]).format(sharekey=sharekey)
-    m3u8mp4_path = path + "/{sharekey}_mp4.m3u8".format(sharekey=sharekey)
-    download_file(m3u8mp4_url, m3u8mp4_path, shib)
+    m3u8mp4_url = (m3u8_url[0:-4]+variant).format(sharekey=sharekey)
+    fetch_file("{sharekey}_mp4.m3u8".format(sharekey=sharekey), 
+               m3u8mp4_url, path, shib, manifest)
     
     
     return 0
     
-def get_ts(key, sharekey, path, shib):
+@phase("get_ts")
+def get_ts(key, sharekey, path, shib, workers = 1, max_per_host = MAX_PER_HOST, 
+           manifest = None):
+    """
+    Downloads the transport stream segments listed in the mp4 playlist.
+    With workers > 1 the segments are fetched concurrently, but never more
+    at once than the adaptive per-host limit allows, at most max_per_host.
+    files.txt always keeps the playlist order.
+    If a single segment fails, the exception is raised after the pending
+    segments have been cancelled, so that the medium can be discarded.
+    Given a manifest, finished segments are skipped and partial ones resumed.
+    
+    """
     url = "https://videocampus.sachsen.de/media/hlsMedium/key/{sharekey}/format/auto/ext/mp4/learning/0/path/".format(sharekey=sharekey)    
     m3u8mp4_path = path + "/{sharekey}_mp4.m3u8".format(sharekey=sharekey)
 
     with open(m3u8mp4_path) as file:
-        lines = [line.rstrip() for line in file]
-    
-
-    
-    ts_keys = [ x for x in lines if "EXT" not in x]
+        ts_keys = parse_segments(file.read())
     
     logging.info("%s: Write files.txt for %s" % (key, sharekey))
     
@@ -194,10 +668,100 @@ def get_ts(key, sharekey, path, shib):
         for ts in ts_keys:
             print(f"file '{ts}' ", file=text_file)
     
-    for tkey in ts_keys:
+    def fetch(tkey):
+        if manifest is not None and manifest.complete(tkey, path+"/"+tkey):
+            logging.debug("%s: Skip %s" % (key, tkey))
+            return
         logging.info("%s: Download %s" % (key, tkey))
         durl = url+tkey
-        ts_path = path+"/"+tkey
-        download_file(durl, ts_path, shib)
+        with host_slot(durl, max_per_host):
+            fetch_file(tkey, durl, path, shib, manifest)
+    
+    if workers <= 1:
+        for tkey in ts_keys:
+            fetch(tkey)
+        return 0
+    
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(fetch, tkey) for tkey in ts_keys]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
         
-    return 0
\ No newline at end of file
+    return 0
+
+@phase("remux")
+def remux_ts(key, sharekey, output, shib, workers = 1, max_per_host = MAX_PER_HOST, quality = None):
+    """
+    Streams the segments of a medium in playlist order into the stdin of
+    ffmpeg, which remuxes them into output. Neither the playlists nor the
+    segments touch the disk. At most 2 * workers segments are held in memory
+    while waiting for their predecessors. ffmpeg writes to a temporary name
+    that is only renamed to output once ffmpeg succeeded. With quality
+    audio, only the audio stream is kept. Returns the duration, size and
+    checksum of the medium, see medium_metadata.
+    
+    """
+    url = "https://videocampus.sachsen.de/media/hlsMedium/key/{sharekey}/format/auto/ext/mp4/learning/0/path/".format(sharekey=sharekey)
+    
+    logging.info("%s: Download m3u8 for %s" % (key, sharekey))
+    response = get_page(shib, url+"m3u8")
+    response.raise_for_status()
+    response = get_page(shib, url+parse_master(response.text, quality))
+    response.raise_for_status()
+    ts_keys = parse_segments(response.text)
+    duration = parse_duration(response.text)
+    digests = list()
+    size = 0
+    
+    def fetch(tkey):
+        logging.info("%s: Download %s" % (key, tkey))
+        with host_slot(url+tkey, max_per_host) as slot:
+            r = slot.call(shib.session.get, url+tkey)
+            r.raise_for_status()
+            expected = r.headers.get('Content-Length')
+            if expected is not None and 'Content-Encoding' not in r.headers and len(r.content) != int(expected):
+                raise IOError("Got %d of %s bytes for url: %s" % (len(r.content), expected, url+tkey))
+            transport.throttle(shib.session, len(r.content))
+            return r.content, hashlib.sha256(r.content).hexdigest()
+    
+    def write(future):
+        nonlocal size
+        content, digest = future.result()
+        ffmpeg.stdin.write(content)
+        digests.append(digest)
+        size += len(content)
+    
+    tmp_output = output + ".part"
+    streams = ['-vn', '-c:a', 'copy'] if quality == "audio" else ['-c', 'copy']
+    ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'mpegts', '-i', 'pipe:0'] + 
+                              streams + ['-f', 'matroska', tmp_output], stdin = subprocess.PIPE)
+    window = deque()
+    
+    try:
+        with ThreadPoolExecutor(max_workers = max(workers, 1)) as executor:
+            for tkey in ts_keys:
+                window.append(executor.submit(fetch, tkey))
+                if len(window) >= 2 * max(workers, 1):
+                    write(window.popleft())
+            while window:
+                write(window.popleft())
+        ffmpeg.stdin.close()
+        if ffmpeg.wait() != 0:
+            raise RuntimeError("ffmpeg exited with status %d" % ffmpeg.returncode)
+    except Exception:
+        for future in window:
+            future.cancel()
+        ffmpeg.kill()
+        ffmpeg.wait()
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+    
+    os.replace(tmp_output, output)
+    
+    return {"duration": duration, "size": size, "checksum": medium_checksum(digests)}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+import threading
+
+SEARCH_FN = 'search.db'
+
+class SearchIndex:
+    """
+    Full-text index over the metadata of all media in search.db, next to
+    the store. The media table holds one row per medium, the FTS5 table
+    media_text indexes their title, course node and label and is kept in
+    sync by triggers. Without FTS5 in the sqlite3 library, searches fall
+    back to LIKE. The stores update the index on every change, so queries
+    never have to load the store.
+
+    """
+
+    _schema = """
+    CREATE TABLE IF NOT EXISTS media (
+        label TEXT NOT NULL,
+        sharekey TEXT NOT NULL,
+        title TEXT,
+        node TEXT,
+        node_url TEXT,
+        type TEXT,
+        duration REAL,
+        size INTEGER,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (label, sharekey)
+    );
+    """
+
+    _fts_schema = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS media_text USING fts5(
+        title, node, label, content = 'media'
+    );
+    CREATE TRIGGER IF NOT EXISTS media_insert AFTER INSERT ON media BEGIN
+        INSERT INTO media_text (rowid, title, node, label) VALUES (new.rowid, new.title, new.node, new.label);
+    END;
+    CREATE TRIGGER IF NOT EXISTS media_delete AFTER DELETE ON media BEGIN
+        INSERT INTO media_text (media_text, rowid, title, node, label)
+        VALUES ('delete', old.rowid, old.title, old.node, old.label);
+    END;
+    CREATE TRIGGER IF NOT EXISTS media_update AFTER UPDATE ON media BEGIN
+        INSERT INTO media_text (media_text, rowid, title, node, label)
+        VALUES ('delete', old.rowid, old.title, old.node, old.label);
+        INSERT INTO media_text (rowid, title, node, label) VALUES (new.rowid, new.title, new.node, new.label);
+    END;
+    """
+
+    _columns = ("label", "sharekey", "title", "node", "node_url", "type", "duration", "size", "downloaded")
+
+    def __init__(self, fn = SEARCH_FN):
+        self.fn = fn
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(fn, timeout = 30, check_same_thread = False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self._schema)
+        try:
+            self._db.executescript(self._fts_schema)
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.debug("sqlite3 has no FTS5, searches fall back to LIKE.")
+            self.fts = False
+
+    @property
+    def built(self):
+        """
+        True once the index was built from the whole store, see rebuild.
+
+        """
+        with self._lock:
+            return self._db.execute("PRAGMA user_version").fetchone()[0] > 0
+
+    def _row(self, label, medium):
+        return (label, medium.get("sharekey"), medium.get("title"), medium.get("node"),
+                medium.get("node_url"), medium.get("type"), medium.get("duration"),
+                medium.get("size"), int(bool(medium.get("downloaded"))))
+
+    def _insert(self, label, media):
+        self._db.executemany("INSERT INTO media (%s) VALUES (%s) ON CONFLICT(label, sharekey) DO NOTHING"
+                             % (", ".join(self._columns), ", ".join("?" * len(self._columns))),
+                             [self._row(label, medium) for medium in media])
+
+    def add(self, label, media):
+        with self._lock, self._db:
+            self._insert(label, media)
+
+    def update(self, label, sharekey, **fields):
+        """
+        Updates the indexed fields of a medium, other fields are ignored.
+
+        """
+        fields = {key: (int(bool(val)) if key == "downloaded" else val)
+                  for key, val in fields.items() if key in self._columns[2:]}
+        if not fields:
+            return
+        with self._lock, self._db:
+            self._db.execute("UPDATE media SET %s WHERE label = ? AND sharekey = ?"
+                             % ", ".join("%s = ?" % key for key in fields),
+                             tuple(fields.values()) + (label, sharekey))
+
+    def delete(self, label):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM media WHERE label = ?", (label,))
+
+    def rebuild(self, content):
+        """
+        Replaces the index with the media of content, the content of a
+        store.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM media")
+            for label, repository in content.items():
+                self._insert(label, repository.get("media", []))
+            self._db.execute("PRAGMA user_version = 1")
+        logging.info("Indexed the media of %d repositories." % len(content))
+
+    def _select(self, sql, params):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            return [dict(zip(self._columns, row)) for row in cursor.fetchall()]
+
+    def search(self, query, limit = 50):
+        """
+        Returns the media whose title, course node or label contain all
+        words of query, or words starting with them, best matches first.
+
+        """
+        words = query.split()
+        if not words:
+            return []
+        columns = ", ".join("media." + column for column in self._columns)
+
+        if self.fts:
+            match = " ".join('"%s"*' % word.replace('"', '""') for word in words)
+            return self._select("SELECT %s FROM media_text JOIN media ON media.rowid = media_text.rowid "
+                                "WHERE media_text MATCH ? ORDER BY rank LIMIT ?" % columns, (match, limit))
+
+        condition = " AND ".join(["(title LIKE ? OR node LIKE ? OR label LIKE ?)"] * len(words))
+        params = [pattern for word in words for pattern in ["%" + word + "%"] * 3]
+        return self._select("SELECT %s FROM media WHERE %s ORDER BY rowid LIMIT ?" % (columns, condition),
+                            tuple(params) + (limit,))
+
+    def media(self, label):
+        """
+        Returns the media of a repository in the order they were found.
+
+        """
+        return self._select("SELECT %s FROM media WHERE label = ? ORDER BY rowid"
+                            % ", ".join(self._columns), (label,))
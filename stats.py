@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+class Stats:
+    """
+    Collects per-request latency, bytes, status and retries of a session
+    and the time spent in each phase of the pipeline.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.requests = list()
+        self.phases = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "errors": 0})
+
+    def instrument(self, session):
+        self.enabled = True
+        session.hooks['response'].append(self.hook)
+
+    def add(self, method, url, status, seconds, size, retries = 0):
+        with self._lock:
+            self.requests.append({"method": method, "host": urlparse(url).netloc, "status": status,
+                                  "seconds": seconds, "bytes": size, "retries": retries})
+
+    def hook(self, response, *args, **kwargs):
+        if response.headers.get('Content-Length') is not None:
+            size = int(response.headers['Content-Length'])
+        elif getattr(response, '_content_consumed', False):
+            size = len(response.content or b'')
+        else:
+            size = 0
+
+        retries = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        self.add(response.request.method, response.url, response.status_code,
+                 response.elapsed.total_seconds(), size, len(retries))
+
+    def record(self, name, seconds, error = False):
+        with self._lock:
+            self.phases[name]["calls"] += 1
+            self.phases[name]["seconds"] += seconds
+            self.phases[name]["errors"] += int(error)
+
+    def hosts(self):
+        hosts = defaultdict(lambda: {"requests": 0, "seconds": 0.0, "bytes": 0, "retries": 0,
+                                     "status": defaultdict(int), "latencies": list()})
+        for record in self.requests:
+            host = hosts[record["host"]]
+            host["requests"] += 1
+            host["seconds"] += record["seconds"]
+            host["bytes"] += record["bytes"]
+            host["retries"] += record["retries"]
+            host["status"][record["status"]] += 1
+            host["latencies"].append(record["seconds"])
+        return hosts
+
+    def summary(self):
+        """
+        Logs the time spent per phase and the requests per host.
+
+        """
+        logging.info("Run took %.1f s" % (time.time() - self.start))
+        for name, phase in sorted(self.phases.items(), key = lambda item: -item[1]["seconds"]):
+            logging.info("%-18s %6d calls %10.1f s %4d errors" % (name, phase["calls"], phase["seconds"],
+                                                                 phase["errors"]))
+        for name, host in sorted(self.hosts().items()):
+            latencies = sorted(host["latencies"])
+            logging.info("%-28s %6d requests %10.1f MB  p50 %.3f s  p95 %.3f s  %d retries  %s" % (
+                name, host["requests"], host["bytes"] / 1e6,
+                latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)],
+                host["retries"], dict(host["status"])))
+
+    def prometheus(self):
+        families = [("opal_scraper_run_seconds", "gauge", [("", time.time() - self.start)])]
+
+        for metric, key in (("seconds", "seconds"), ("calls", "calls"), ("errors", "errors")):
+            families.append(("opal_scraper_phase_%s_total" % metric, "counter",
+                             [('{phase="%s"}' % name, phase[key]) for name, phase in sorted(self.phases.items())]))
+
+        hosts = sorted(self.hosts().items())
+        families.append(("opal_scraper_requests_total", "counter",
+                         [('{host="%s",status="%s"}' % (name, status), count) for name, host in hosts
+                          for status, count in sorted(host["status"].items())]))
+        for metric, key in (("request_seconds", "seconds"), ("response_bytes", "bytes"), ("retries", "retries")):
+            families.append(("opal_scraper_%s_total" % metric, "counter",
+                             [('{host="%s"}' % name, host[key]) for name, host in hosts]))
+
+        lines = list()
+        for family, kind, samples in families:
+            lines.append("# TYPE %s %s" % (family, kind))
+            lines += ["%s%s %s" % (family, labels, value) for labels, value in samples]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, fn):
+        """
+        Writes the stats to fn, in the Prometheus textfile format if fn ends
+        with .prom and as JSON otherwise. The file is replaced atomically,
+        so that a collector never reads a partial file.
+
+        """
+        with open(fn + ".tmp", "w") as write_file:
+            if fn.endswith(".prom"):
+                write_file.write(self.prometheus())
+            else:
+                json.dump({"seconds": time.time() - self.start, "phases": self.phases,
+                           "requests": self.requests}, write_file, indent = 2)
+        os.replace(fn + ".tmp", fn)
+
+
+STATS = Stats()
+
+def phase(name):
+    """
+    Decorator that adds the run time of each call to the phase name. It
+    works for plain functions and coroutine functions.
+
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await function(*args, **kwargs)
+                except BaseException:
+                    STATS.record(name, time.perf_counter() - start, error = True)
+                    raise
+                STATS.record(name, time.perf_counter() - start)
+                return result
+            return coroutine
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                STATS.record(name, time.perf_counter() - start, error = True)
+                raise
+            STATS.record(name, time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from search import SearchIndex, SEARCH_FN
+
+JSON_FN = 'content.json'
+SQLITE_FN = 'content.db'
+
+def merge_media(media, found):
+    """
+    Appends the media in found whose sharekey is not in media yet. Known
+    media keep their entry, including the downloaded flag. New media are
+    stamped with the time they were added. Returns the media that were
+    added.
+
+    """
+    known = {medium.get("sharekey") for medium in media}
+    added = list()
+    now = int(time.time())
+
+    for medium in found:
+        if medium.get("sharekey") not in known:
+            medium = dict(medium, downloaded = False)
+            medium.setdefault("added", now)
+            media.append(medium)
+            added.append(medium)
+            known.add(medium.get("sharekey"))
+
+    return added
+
+def open_store(indexed = False):
+    """
+    Returns the SQLite store if content.db exists, the JSON store otherwise.
+    With indexed, for commands that read or change media, the store keeps
+    the search index up to date, which is built from the store first if it
+    doesn't exist yet.
+
+    """
+    index = SearchIndex(SEARCH_FN) if indexed else None
+    if Path(SQLITE_FN).exists():
+        store = SQLiteStore(SQLITE_FN, index)
+    else:
+        store = JSONStore(JSON_FN, index)
+
+    if index is not None and not index.built and Path(store.fn).exists():
+        index.rebuild(store.content())
+
+    return store
+
+
+class Manifest:
+    """
+    Keeps track of the files of a medium that were downloaded completely,
+    together with their size in bytes and SHA-256 digest. The manifest is
+    stored as manifest.json in the directory of the medium and rewritten
+    after every finished file, so that an interrupted download can be
+    resumed.
+
+    """
+
+    def __init__(self, path):
+        self._fn = path + "/manifest.json"
+        self._lock = threading.Lock()
+        self.files = {}
+        self.digests = {}
+
+        if Path(self._fn).exists():
+            try:
+                with open(self._fn, "r") as read_file:
+                    data = json.load(read_file)
+                self.files = data.get("files", {})
+                self.digests = data.get("digests", {})
+            except ValueError:
+                logging.warning("%s is corrupt and will be rebuilt." % self._fn)
+
+    def complete(self, name, path):
+        size = self.files.get(name)
+        return size is not None and os.path.exists(path) and os.path.getsize(path) == size
+
+    def add(self, name, size, digest = None):
+        with self._lock:
+            self.files[name] = size
+            self.digests[name] = digest
+            with open(self._fn + ".tmp", "w") as write_file:
+                json.dump({"files": self.files, "digests": self.digests}, write_file, indent = 2)
+            os.replace(self._fn + ".tmp", self._fn)
+
+
+def _copy(value):
+    """
+    Copies the dicts and lists of parsed JSON, faster than copy.deepcopy.
+
+    """
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+class JSONStore:
+    """
+    Keeps settings, repositories and media in content.json. Every change is
+    a read-modify-write of the whole file. Media changes are passed on to
+    the search index, if there is one.
+
+    The parsed file is kept between calls and only read again when another
+    process replaced it. Reads hand out copies, so callers may change them.
+
+    """
+
+    def __init__(self, fn = JSON_FN, index = None):
+        self.fn = fn
+        self.index = index
+        self._lock = threading.RLock()
+        self._data = None
+        self._stamp = None
+
+    def _stat(self):
+        stat = os.stat(self.fn)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, create = False):
+        """
+        Returns the cached content of the file. Writers change it in place
+        and save it; readers must copy what they return.
+
+        """
+        with self._lock:
+            try:
+                stamp = self._stat()
+            except FileNotFoundError:
+                if not create:
+                    raise FileNotFoundError(self.fn + " was not found.")
+                logging.info('Json file for content has been created')
+                self._data, self._stamp = {}, None
+                return self._data
+
+            if stamp != self._stamp:
+                with open(self.fn, "r") as read_file:
+                    self._data = json.load(read_file)
+                self._stamp = stamp
+            return self._data
+
+    def _save(self, data):
+        try:
+            with open(self.fn + ".tmp", "w") as write_file:
+                json.dump(data, write_file, indent = 2)
+            os.replace(self.fn + ".tmp", self.fn)
+        except BaseException:
+            # Read the file again rather than keep changes that were not saved
+            self._data, self._stamp = None, None
+            raise
+        self._data, self._stamp = data, self._stat()
+
+    def get(self, key, default = None):
+        with self._lock:
+            return _copy(self._load().get(key, default))
+
+    def set(self, key, val):
+        with self._lock:
+            data = self._load(create = True)
+            data[key] = val
+            self._save(data)
+
+    def settings(self):
+        with self._lock:
+            return {key: _copy(val) for key, val in self._load().items() if key != "content"}
+
+    def content(self):
+        with self._lock:
+            return _copy(self._load().get("content", {}))
+
+    def snapshot(self):
+        """
+        Returns the settings and the content from a single read of the file.
+
+        """
+        with self._lock:
+            return self.settings(), self.content()
+
+    def add_repository(self, label, target, options = None):
+        with self._lock:
+            data = self._load(create = True)
+            content = data.setdefault("content", {})
+            if label in content:
+                raise KeyError("Key " + label + " is already in use.")
+            content[label] = dict(options or {}, target = target)
+            self._save(data)
+
+    def update_repository(self, label, **options):
+        with self._lock:
+            data = self._load()
+            if label not in data.get("content", {}):
+                raise KeyError("Key " + label + " was not found in " + self.fn)
+            data["content"][label].update(options)
+            self._save(data)
+
+    def delete_repository(self, label):
+        with self._lock:
+            data = self._load()
+            if label not in data.get("content", {}):
+                raise KeyError("Key " + label + " was not found in " + self.fn)
+            data["content"].pop(label)
+            self._save(data)
+            if self.index is not None:
+                self.index.delete(label)
+
+    def add_media(self, label, found):
+        with self._lock:
+            data = self._load()
+            repository = data["content"][label]
+            added = merge_media(repository.setdefault("media", []), found)
+            if added:
+                self._save(data)
+                if self.index is not None:
+                    self.index.add(label, added)
+            return added
+
+    def update_medium(self, label, sharekey, **fields):
+        with self._lock:
+            data = self._load()
+            if label not in data["content"]:
+                # The repository was deleted meanwhile
+                return
+            for medium in data["content"][label].get("media", []):
+                if medium.get("sharekey") == sharekey:
+                    medium.update(fields)
+            self._save(data)
+            if self.index is not None:
+                self.index.update(label, sharekey, **fields)
+
+    def manifest(self, label, sharekey, path):
+        return Manifest(path)
+
+
+class SegmentManifest:
+    """
+    Manifest of a medium that lives in the segments table of the SQLite store.
+
+    """
+
+    def __init__(self, store, label, sharekey):
+        self._store = store
+        self._label = label
+        self._sharekey = sharekey
+        rows = store._query("SELECT name, size, sha256 FROM segments WHERE label = ? AND sharekey = ?",
+                            (label, sharekey))
+        self.files = {name: size for name, size, digest in rows}
+        self.digests = {name: digest for name, size, digest in rows}
+
+    def complete(self, name, path):
+        size = self.files.get(name)
+        return size is not None and os.path.exists(path) and os.path.getsize(path) == size
+
+    def add(self, name, size, digest = None):
+        self.files[name] = size
+        self.digests[name] = digest
+        self._store._execute("INSERT OR REPLACE INTO segments (label, sharekey, name, size, sha256) "
+                             "VALUES (?, ?, ?, ?, ?)", (self._label, self._sharekey, name, size, digest))
+
+
+class SQLiteStore:
+    """
+    Keeps settings, repositories, media and segments in content.db. Changes
+    are written row by row and the database runs in WAL mode, so that an
+    update and a download can run at the same time. Media changes are
+    passed on to the search index, if there is one.
+
+    """
+
+    _schema = """
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS repositories (
+        label TEXT PRIMARY KEY,
+        target TEXT NOT NULL,
+        options TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE TABLE IF NOT EXISTS media (
+        label TEXT NOT NULL REFERENCES repositories(label) ON DELETE CASCADE,
+        sharekey TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        title TEXT,
+        type TEXT,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        extra TEXT NOT NULL DEFAULT '{}',
+        PRIMARY KEY (label, sharekey)
+    );
+    CREATE INDEX IF NOT EXISTS media_sharekey ON media(sharekey);
+    CREATE TABLE IF NOT EXISTS segments (
+        label TEXT NOT NULL,
+        sharekey TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER,
+        sha256 TEXT,
+        PRIMARY KEY (label, sharekey, name),
+        FOREIGN KEY (label, sharekey) REFERENCES media(label, sharekey) ON DELETE CASCADE
+    );
+    """
+
+    _columns = ("sharekey", "title", "type", "downloaded")
+
+    def __init__(self, fn = SQLITE_FN, index = None):
+        self.fn = fn
+        self.index = index
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(fn, timeout = 30, check_same_thread = False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(self._schema)
+        # Stores created before segment digests were recorded
+        if "sha256" not in [row[1] for row in self._db.execute("PRAGMA table_info(segments)")]:
+            self._db.execute("ALTER TABLE segments ADD COLUMN sha256 TEXT")
+
+    def _query(self, sql, params = ()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params = ()):
+        with self._lock, self._db:
+            return self._db.execute(sql, params)
+
+    def _medium(self, row):
+        sharekey, title, type, downloaded, extra = row
+        medium = {"title": title, "sharekey": sharekey, "type": type,
+                  "downloaded": bool(downloaded)}
+        medium.update(json.loads(extra))
+        return medium
+
+    def get(self, key, default = None):
+        rows = self._query("SELECT value FROM settings WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set(self, key, val):
+        self._execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                      (key, json.dumps(val)))
+
+    def settings(self):
+        return {key: json.loads(value) for key, value in self._query("SELECT key, value FROM settings")}
+
+    def content(self):
+        content = dict()
+        for label, target, options in self._query("SELECT label, target, options FROM repositories"):
+            content[label] = dict(json.loads(options), target = target, media = list())
+
+        for row in self._query("SELECT label, sharekey, title, type, downloaded, extra FROM media "
+                               "ORDER BY label, position"):
+            content[row[0]]["media"].append(self._medium(row[1:]))
+
+        return content
+
+    def snapshot(self):
+        with self._lock:
+            return self.settings(), self.content()
+
+    def media(self, label):
+        return [self._medium(row) for row in
+                self._query("SELECT sharekey, title, type, downloaded, extra FROM media "
+                            "WHERE label = ? ORDER BY position", (label,))]
+
+    def add_repository(self, label, target, options = None):
+        try:
+            self._execute("INSERT INTO repositories (label, target, options) VALUES (?, ?, ?)",
+                          (label, target, json.dumps(options or {})))
+        except sqlite3.IntegrityError:
+            raise KeyError("Key " + label + " is already in use.")
+
+    def update_repository(self, label, **options):
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT options FROM repositories WHERE label = ?", (label,)).fetchall()
+            if not rows:
+                raise KeyError("Key " + label + " was not found in " + self.fn)
+            self._db.execute("UPDATE repositories SET options = ? WHERE label = ?",
+                             (json.dumps(dict(json.loads(rows[0][0]), **options)), label))
+
+    def delete_repository(self, label):
+        if self._execute("DELETE FROM repositories WHERE label = ?", (label,)).rowcount == 0:
+            raise KeyError("Key " + label + " was not found in " + self.fn)
+        if self.index is not None:
+            self.index.delete(label)
+
+    def add_media(self, label, found):
+        with self._lock, self._db:
+            media = self.media(label)
+            added = merge_media(media, found)
+            position = len(media) - len(added)
+            for offset, medium in enumerate(added):
+                extra = {k: v for k, v in medium.items() if k not in self._columns}
+                self._db.execute("INSERT INTO media (label, sharekey, position, title, type, downloaded, extra) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (label, medium["sharekey"], position + offset, medium.get("title"),
+                                  medium.get("type"), int(medium.get("downloaded", False)), json.dumps(extra)))
+        if added and self.index is not None:
+            self.index.add(label, added)
+        return added
+
+    def update_medium(self, label, sharekey, **fields):
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT extra FROM media WHERE label = ? AND sharekey = ?",
+                                    (label, sharekey)).fetchall()
+            if not rows:
+                return
+            extra = json.loads(rows[0][0])
+            for key, val in fields.items():
+                if key in ("title", "type", "downloaded"):
+                    self._db.execute("UPDATE media SET %s = ? WHERE label = ? AND sharekey = ?" % key,
+                                     (val, label, sharekey))
+                else:
+                    extra[key] = val
+            self._db.execute("UPDATE media SET extra = ? WHERE label = ? AND sharekey = ?",
+                             (json.dumps(extra), label, sharekey))
+        if self.index is not None:
+            self.index.update(label, sharekey, **fields)
+
+    def manifest(self, label, sharekey, path):
+        return SegmentManifest(self, label, sharekey)
+
+    def migrate(self, source):
+        """
+        Copies settings, repositories and media of another store, usually
+        the JSON store, into this one.
+
+        """
+        with self._lock, self._db:
+            for key, val in source.settings().items():
+                self.set(key, val)
+            for label, repository in source.content().items():
+                options = {k: v for k, v in repository.items() if k not in ("target", "media")}
+                self._db.execute("INSERT INTO repositories (label, target, options) VALUES (?, ?, ?) "
+                                 "ON CONFLICT(label) DO UPDATE SET target = excluded.target, options = excluded.options",
+                                 (label, repository["target"], json.dumps(options)))
+                media = [dict(medium, downloaded = False) for medium in repository.get("media", [])]
+                self.add_media(label, media)
+                for medium in repository.get("media", []):
+                    if medium.get("downloaded"):
+                        self.update_medium(label, medium["sharekey"], downloaded = True)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Captures requests to an archive and replays them. Run it with
+
+python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+import requests
+from requests.structures import CaseInsensitiveDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from capture import Archive, ReplayAdapter
+
+URL = "https://bildungsportal.sachsen.de/opal/search?user=%s&page=1"
+
+def response(body):
+    captured = requests.Response()
+    captured.status_code = 200
+    captured.reason = "OK"
+    captured.headers = CaseInsensitiveDict({"Content-Type": "text/html"})
+    return captured, body
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.fn = os.path.join(directory.name, "trace.zip")
+
+    def capture(self, words, url):
+        archive = Archive(self.fn, words)
+        archive.add(requests.Request("GET", url).prepare(), *response(b"<p>alice</p>"))
+        archive.close()
+
+    def replay(self, url):
+        adapter = ReplayAdapter(self.fn, speed = 0)
+        self.addCleanup(adapter._zip.close)
+        return adapter.send(requests.Request("GET", url).prepare())
+
+    def test_words_are_redacted(self):
+        self.capture(["alice"], URL % "alice")
+        with zipfile.ZipFile(self.fn) as archive:
+            for name in archive.namelist():
+                self.assertNotIn(b"alice", archive.read(name), name)
+
+    def test_replay_redacts_like_the_capture(self):
+        self.capture(["alice"], URL % "alice")
+        replayed = self.replay(URL % "alice")
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.content, b"<p>REDACTED</p>")
+        self.assertEqual(self.replay(URL % "bob").status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
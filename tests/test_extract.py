@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the extractors of extract.py with a full BeautifulSoup parse of
+saved OPAL, VCS and login pages in fixtures/. Run it with
+
+python -m unittest discover tests
+
+"""
+
+import os
+import re
+import sys
+import unittest
+from unittest import mock
+from bs4 import BeautifulSoup
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extract
+
+FIXTURES = os.path.join(HERE, "fixtures")
+MALFORMED = ("malformed.html",)
+
+videocampus = re.compile("videocampus")
+
+# The lookups of the scraper and the login chain
+QUERIES = (
+    ("a", "href", None, videocampus),
+    ("a", "href", None, None),
+    ("a", "href", {"id": "redirect"}, None),
+    ("iframe", "src", None, None),
+    ("video", "data-piwik-title", None, None),
+    ("input", "value", {"name": "sharekey"}, None),
+    ("input", "value", {"name": "AuthState"}, None),
+    ("input", "value", {"name": "SAMLResponse"}, None),
+    ("input", "value", {"name": "RelayState"}, None),
+    ("form", "action", {"id": "id10"}, None),
+    ("form", "id", {"id": "id10"}, None),
+)
+
+def fixtures():
+    return sorted(fn for fn in os.listdir(FIXTURES) if fn.endswith(".html"))
+
+def read(fn):
+    with open(os.path.join(FIXTURES, fn), encoding = "utf-8") as f:
+        return f.read()
+
+def soup_values(page, tag, attr, match = None, pattern = None):
+    soup = BeautifulSoup(page, "html.parser")
+    return [element.get(attr) for element in soup.find_all(tag, attrs = match or {})
+            if element.get(attr) is not None
+            and (pattern is None or pattern.search(element.get(attr)))]
+
+
+class ExtractTest(unittest.TestCase):
+
+    def test_matches_beautifulsoup(self):
+        for fn in fixtures():
+            page = read(fn)
+            for tag, attr, match, pattern in QUERIES:
+                with self.subTest(fixture = fn, tag = tag, attr = attr, match = match):
+                    self.assertEqual(extract.find_all_attr(page, tag, attr, match, pattern),
+                                     soup_values(page, tag, attr, match, pattern))
+
+    def test_well_formed_pages_are_not_parsed(self):
+        with mock.patch.object(extract, "_soup", side_effect = AssertionError("fell back to BeautifulSoup")):
+            for fn in fixtures():
+                if fn in MALFORMED:
+                    continue
+                page = read(fn)
+                for tag, attr, match, pattern in QUERIES:
+                    with self.subTest(fixture = fn, tag = tag, attr = attr, match = match):
+                        extract.find_all_attr(page, tag, attr, match, pattern)
+
+    def test_malformed_pages_are_parsed(self):
+        for fn in MALFORMED:
+            tags, trusted = extract._start_tags(read(fn), "a")
+            self.assertFalse(trusted)
+
+    def test_tags_with_the_same_prefix(self):
+        page = '<abbr title="OPAL">OPAL</abbr><address>Chemnitz</address>'
+        with mock.patch.object(extract, "_soup", side_effect = AssertionError("fell back to BeautifulSoup")):
+            self.assertEqual(extract.find_all_attr(page, "a", "title"), [])
+            self.assertIsNone(extract.find_attr(page, "a", "href"))
+
+    def test_scripts_and_comments(self):
+        page = """<script>var t='<iframe src="/opal/tmpl">'</script><!-- <iframe src="/opal/old"> -->
+<iframe src="/opal/real">"""
+        self.assertEqual(extract.find_attr(page, "iframe", "src"), "/opal/real")
+        self.assertEqual(extract.find_all_attr(read("opal_scripts_comments.html"), "a", "href", pattern = videocampus),
+                         ["https://videocampus.sachsen.de/m/3333live", "https://videocampus.sachsen.de/m/5555live"])
+
+    def test_unterminated_comments_are_parsed(self):
+        page = '<a href="/live">live</a><!-- <a href="/commented">'
+        self.assertEqual(extract.find_all_attr(page, "a", "href"), soup_values(page, "a", "href"))
+
+    def test_single_values(self):
+        self.assertEqual(extract.input_value(read("vcs_medium.html"), "sharekey"),
+                         soup_values(read("vcs_medium.html"), "input", "value", {"name": "sharekey"})[0])
+        self.assertEqual(extract.find_attr(read("vcs_medium.html"), "video", "data-piwik-title"),
+                         "Vorlesung 1: Einführung & Überblick")
+        self.assertIsNone(extract.input_value(read("opal_course_node_links.html"), "sharekey"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the commands which only touch content.json start without the
+heavy modules. Run it with
+
+python -m unittest discover tests
+
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from benchmark import HEAVY
+
+SCRIPT = os.path.join(os.path.dirname(HERE), "opal-scraper.py")
+URL = "https://bildungsportal.sachsen.de/opal/auth/RepositoryEntry/%d"
+
+def imported(directory, *args):
+    result = subprocess.run([sys.executable, "-X", "importtime", SCRIPT, *args],
+                            cwd = directory, check = True, capture_output = True, text = True)
+    return {line.rpartition("|")[2].strip().split(".")[0] for line in result.stderr.splitlines()
+            if line.startswith("import time:")}
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_add_imports_no_heavy_modules(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(imported(directory, "--add", "R0", URL % 0) & set(HEAVY), set())
+            self.assertEqual(imported(directory, "--add", "R1", URL % 1) & set(HEAVY), set())
+            self.assertTrue(os.path.exists(os.path.join(directory, "content.json")))
+
+
+if __name__ == '__main__':
+    unittest.main()
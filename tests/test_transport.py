@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks how the adaptive per-host limit of transport.py reacts to the
+latency and the throttling of a host.
+
+"""
+
+import contextlib
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import transport
+
+def respond(limit, seconds = None, throttled = False):
+    """
+    Records a response while all slots of the limit are taken, like in a
+    crawl that has more requests than the limit allows.
+
+    """
+    with contextlib.ExitStack() as stack:
+        for slot in range(limit.level):
+            stack.enter_context(limit)
+        limit.record(seconds, throttled = throttled, cuts = limit.cuts)
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def test_grows_while_healthy(self):
+        limit = transport.AdaptiveLimit("host", 4, 16)
+        for response in range(200):
+            respond(limit, 0.1)
+        self.assertEqual(limit.level, 16)
+
+    def test_halves_when_throttled(self):
+        limit = transport.AdaptiveLimit("host", 8, 16)
+        respond(limit, 0.1)
+        respond(limit, 0.1, throttled = True)
+        self.assertEqual(limit.level, 4)
+
+    def test_single_spike(self):
+        limit = transport.AdaptiveLimit("host", 8, 16)
+        for response in range(50):
+            respond(limit, 0.1)
+        level = limit.level
+        respond(limit, 1.0)
+        self.assertEqual(limit.level, level // 2)
+        self.assertLess(limit.latency, 0.2)
+
+    def test_latency_level_shift(self):
+        limit = transport.AdaptiveLimit("host", 4, 16)
+        for response in range(50):
+            respond(limit, 0.1)
+        for response in range(500):
+            respond(limit, 0.5)
+        self.assertGreater(limit.latency, 0.4)
+        self.assertEqual(limit.level, 16)
+
+    def test_stale_cuts(self):
+        limit = transport.AdaptiveLimit("host", 8, 16)
+        cuts = limit.cuts
+        limit.record(error = True, cuts = cuts)
+        limit.record(error = True, cuts = cuts)
+        self.assertEqual(limit.level, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
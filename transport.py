@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connect and read timeout in seconds
+TIMEOUT = (10, 60)
+RETRIES = 5
+BACKOFF = 0.5
+# Requests per second and host
+RATE = 20.0
+# Responses that ask the adaptive limit to back off, and the latency, as a
+# multiple of the usual one, that counts as a spike
+THROTTLED = (429, 503)
+SPIKE = 3.0
+# Weights of a healthy response and of a spike in the usual latency
+LATENCY_WEIGHT = 0.1
+SPIKE_WEIGHT = 0.05
+
+class TokenBucket:
+    """
+    Hands out up to rate tokens per second, with bursts of up to burst
+    tokens. acquire blocks until enough tokens are available.
+
+    """
+
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount = 1):
+        """
+        Takes amount tokens and returns 0 if they are available, otherwise
+        returns the seconds to wait before trying again.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            if self._tokens >= amount or self._tokens >= self.burst:
+                self._tokens -= amount
+                return 0
+            return (min(amount, self.burst) - self._tokens) / self.rate
+
+    def acquire(self, amount = 1):
+        wait = self.reserve(amount)
+        while wait:
+            time.sleep(wait)
+            wait = self.reserve(amount)
+
+
+class AdaptiveLimit:
+    """
+    Caps the requests in flight to a host with an AIMD controller, like
+    TCP congestion control. Each healthy response raises the limit by
+    1 / limit, that is by one per round of limit responses, up to maximum,
+    as long as the requests in flight use up the limit.
+    429 and 503, also if they were retried, connection errors, timeouts
+    and responses that take SPIKE times the usual latency halve it, down to
+    minimum. Only requests sent after the last cut can cut it again, the
+    ones that were in flight back then report the same trouble. The usual
+    latency is the moving average of the responses that weren't throttled
+    or failed. Spikes count less, but a lasting rise of the latency becomes
+    the usual one after a few cuts. Changes of the limit are logged.
+
+    """
+
+    def __init__(self, name, start, maximum, minimum = 1):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(start, minimum), self.maximum))
+        self.latency = None
+        self.cuts = 0
+        self._in_flight = 0
+        self._changed = threading.Condition()
+
+    @property
+    def level(self):
+        return int(self.limit)
+
+    def __enter__(self):
+        with self._changed:
+            while self._in_flight >= self.level:
+                self._changed.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._changed:
+            self._in_flight -= 1
+            self._changed.notify()
+
+    def cap(self, maximum):
+        """
+        Changes the maximum, e.g. to a setting that was read after the limit
+        was made, and lowers the limit to it if needed.
+
+        """
+        with self._changed:
+            self.maximum = max(maximum, self.minimum)
+            self.limit = min(self.limit, self.maximum)
+            self._changed.notify_all()
+
+    def record(self, seconds = None, throttled = False, error = False, cuts = None):
+        """
+        Adjusts the limit to the outcome of a request that took seconds
+        until its response arrived. cuts is the number of cuts when the
+        request was sent.
+
+        """
+        with self._changed:
+            level = self.level
+            spike = seconds is not None and self.latency is not None and seconds > SPIKE * self.latency
+            if seconds is not None and not throttled and not error:
+                weight = SPIKE_WEIGHT if spike else LATENCY_WEIGHT
+                self.latency = seconds if self.latency is None else (1 - weight) * self.latency + weight * seconds
+            if throttled or error or spike:
+                if cuts is not None and cuts != self.cuts:
+                    return
+                reason = "throttled" if throttled else "errors" if error else "latency %.2f s" % seconds
+                self.limit = max(self.minimum, self.limit / 2)
+                self.cuts += 1
+            else:
+                reason = "healthy"
+                if self._in_flight >= level:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if self.level != level:
+                logging.info("%s: %d requests in flight (was %d, %s)" % (self.name, self.level, level, reason))
+                self._changed.notify_all()
+
+    def observe(self, response, cuts = None):
+        history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        throttled = response.status_code in THROTTLED or any(h.status in THROTTLED for h in history)
+        self.record(response.elapsed.total_seconds(), throttled = throttled, cuts = cuts)
+
+    def call(self, request, *args, **kwargs):
+        """
+        Returns request(*args, **kwargs), e.g. session.get, and adjusts the
+        limit to its outcome. It doesn't take a slot, use with for that.
+
+        """
+        cuts = self.cuts
+        try:
+            response = request(*args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.record(error = True, cuts = cuts)
+            raise
+        self.observe(response, cuts)
+        return response
+
+
+class TransportSession(requests.Session):
+    """
+    requests.Session with a default timeout and a rate limit per host. The
+    rate limit applies to every request sent, including redirects. The
+    bandwidth cap is shared by all hosts and applies to the bytes passed to
+    throttle by whoever reads the responses.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.timeout = None
+        self.rate = None
+        self.bandwidth = None
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def throttle(self, amount):
+        if self.bandwidth is not None:
+            self.bandwidth.acquire(amount)
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate)
+            return self._buckets[host]
+
+    def send(self, request, **kwargs):
+        if self.rate:
+            self.bucket(request.url).acquire()
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def throttle(session, amount):
+    """
+    Waits until amount bytes fit into the bandwidth cap of session, if it
+    has one.
+
+    """
+    if isinstance(session, TransportSession):
+        session.throttle(amount)
+
+def configure(session, timeout = TIMEOUT, retries = RETRIES, backoff = BACKOFF, rate = RATE, pool = 10,
+              bandwidth = None):
+    """
+    Sets timeouts, the per-host rate limit, the bandwidth cap in bytes per
+    second and a retrying connection pool of the given size on session.
+    Failed connections, connection resets, 429 and 5xx responses of
+    idempotent requests are retried with exponential backoff and jitter,
+    honouring Retry-After.
+
+    """
+    options = dict(total = retries, connect = retries, read = retries, status = retries,
+                   backoff_factor = backoff, status_forcelist = (429, 500, 502, 503, 504),
+                   respect_retry_after_header = True, raise_on_status = False)
+    try:
+        retry = Retry(backoff_jitter = backoff, **options)
+    except TypeError:
+        # urllib3 < 2 has no jitter
+        retry = Retry(**options)
+
+    adapter = HTTPAdapter(max_retries = retry, pool_connections = 10, pool_maxsize = max(pool, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    if isinstance(session, TransportSession):
+        session.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        session.rate = rate
+        session.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+        session._buckets.clear()
+    else:
+        logging.warning("Timeouts and rate limits need a TransportSession.")
+
+    return session